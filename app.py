@@ -1,9 +1,85 @@
-from flask import Flask, render_template_string, request, send_file
-from fpdf import FPDF
+from flask import Flask, Response, abort, g, jsonify, request, send_file, url_for
+import base64
+import gzip
+import hashlib
 import io
+import os
+import re
 import datetime
+import tempfile
+import time
+import atexit
+import functools
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal, InvalidOperation
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from archive import Archive
+from batch import detect_format, number_invoices, read_invoices, stream_zip
+from font_registry import FONTS
+from jobs import JobQueue, render_batch_file, render_invoice_file, spool_upload
+from layout import HEADER
+from metrics import METRICS
+from model import InvalidInvoice
+from numbering import Ledger
+from pdf_cache import RenderCache
+from profiler import SamplingProfiler
+from render import create_pdf, invoice_from_form, iter_pdf
+from schema import InvalidDocument, invoice_from_json
+from tax import TAX
 
 app = Flask(__name__)
+app.config.setdefault("BATCH_WORKERS", 1)
+app.config.setdefault("RENDER_CACHE_BYTES", 64 * 1024 * 1024)
+# Disk tier shared by worker processes; /invoices/<key>.pdf is only
+# advertised with one, since the in-memory LRU is per process
+app.config.setdefault("RENDER_CACHE_DIR", None)
+# Invoices with at least this many lines are streamed page by page, uncached
+app.config.setdefault("STREAM_MIN_ITEMS", 2000)
+app.config.setdefault("JOB_DIR", os.path.join(tempfile.gettempdir(), "invoice-jobs"))
+app.config.setdefault("JOB_WORKERS", 2)
+app.config.setdefault("JOB_TTL", 3600)
+# Directory shared by worker processes so /metrics can add their numbers up
+app.config.setdefault("METRICS_DIR", os.environ.get("METRICS_DIR"))
+# Allows ?profile=1 on /generate-invoice; keep off in production
+app.config.setdefault("PROFILING", False)
+# SQLite ledger that numbers invoices submitted without a number; off if None
+app.config.setdefault("NUMBERING_DB", os.environ.get("NUMBERING_DB"))
+app.config.setdefault("NUMBERING_SERIES", "")
+# Directory keeping every PDF sent, searchable under /archive; off if None
+app.config.setdefault("ARCHIVE_DIR", os.environ.get("ARCHIVE_DIR"))
+FONTS.preload()
+HEADER.preload()
+PDF_CACHE = RenderCache(app.config["RENDER_CACHE_BYTES"], app.config["RENDER_CACHE_DIR"])
+JOBS = JobQueue(app.config["JOB_DIR"], app.config["JOB_WORKERS"], app.config["JOB_TTL"])
+METRICS.directory = METRICS.directory or app.config["METRICS_DIR"]
+LEDGER = None
+if app.config["NUMBERING_DB"]:
+    LEDGER = Ledger(app.config["NUMBERING_DB"])
+    # Hands this worker's unused numbers back
+    atexit.register(LEDGER.close)
+ARCHIVE = None
+if app.config["ARCHIVE_DIR"]:
+    ARCHIVE = Archive(app.config["ARCHIVE_DIR"])
+METRICS.gauge("render_cache", "Render cache entries, bytes, hits and misses", lambda: {
+    (("value", key),): value for key, value in PDF_CACHE.stats().items()
+})
+METRICS.gauge("font_subset_cache", "Font subset cache entries, hits and misses", lambda: {
+    (("value", key),): value for key, value in FONTS.subsets.stats().items()
+})
+METRICS.gauge("font_registry", "Loaded font faces and face lookups (hits/misses)", lambda: {
+    (("value", key),): value for key, value in FONTS.stats().items() if key in ("faces", "hits", "misses")
+})
+METRICS.gauge("text_width_cache", "Cached string widths per font face, hits and misses", lambda: {
+    (("face", style or "regular"), ("value", key)): value
+    for style, stats in FONTS.stats()["text_widths"].items() for key, value in stats.items()
+})
+METRICS.gauge("page_chrome", "Recorded page header replays (hits) and fallbacks (misses)", lambda: {
+    (("value", "hits"),): HEADER.hits, (("value", "misses"),): HEADER.misses,
+})
 
 form_template = """
 <!DOCTYPE html>
@@ -33,189 +109,376 @@ form_template = """
         <br>
         <fieldset>
             <legend>Invoice Details</legend>
-            Invoice #: <input type="text" name="invoice_number" value="2025/05"><br>
+            {% if numbered %}Invoice #: <input type="text" name="invoice_number" value="" placeholder="assigned when issued"><br>{% else %}Invoice #: <input type="text" name="invoice_number" value="2025/05"><br>{% endif %}
             Date (DD/MM/YYYY): <input type="text" name="invoice_date" value="{{today}}"><br>
             Payment Method: <input type="text" name="payment_method" value="Bank Transfer"><br>
+            Tax Region: <select name="tax_region">{% for region in regions %}<option{% if region == default_region %} selected{% endif %}>{{region}}</option>{% endfor %}</select><br>
         </fieldset>
         <br>
-        <fieldset>
+        <fieldset id="items">
             <legend>Items</legend>
-            Description: <input type="text" name="item_description" value="Electrical Installation"><br>
-            Quantity: <input type="text" name="item_qty" value="1"><br>
-            Unit Price: <input type="text" name="item_price" value="465.00"><br>
+            <div class="item">
+                Description: <input type="text" name="item_description" value="Electrical Installation"><br>
+                Quantity: <input type="text" name="item_qty" value="1"><br>
+                Unit Price: <input type="text" name="item_price" value="465.00"><br>
+                VAT Rate: <input type="text" name="item_vat_rate" value="" placeholder="region default, or e.g. reduced"><br>
+            </div>
         </fieldset>
+        <button type="button" onclick="addItem()">Add item</button>
         <br>
         <input type="submit" value="Generate Invoice PDF">
     </form>
+    <script>
+        function addItem() {
+            var items = document.getElementById("items");
+            var row = items.querySelector(".item").cloneNode(true);
+            row.querySelectorAll("input").forEach(function (input) { input.value = ""; });
+            items.appendChild(document.createElement("hr"));
+            items.appendChild(row);
+        }
+    </script>
 </body>
 </html>
 """
 
+# Compiled once; only the date in it changes, so each day's page is
+# rendered and compressed once and then served from memory
+FORM = app.jinja_env.from_string(form_template)
+_form_pages = {}
+
+def _form_page(today):
+    page = _form_pages.get(today)
+    if page is None:
+        body = FORM.render(
+            today=today, numbered=LEDGER is not None,
+            regions=sorted(TAX.regions), default_region=TAX.default_region,
+        ).encode("utf-8")
+        page = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            page["br"] = brotli.compress(body, quality=11)
+        page["etag"] = hashlib.md5(body, usedforsecurity=False).hexdigest()
+        _form_pages.clear()
+        _form_pages[today] = page
+    return page
+
 @app.route('/')
 def index():
-    today = datetime.date.today().strftime("%d/%m/%Y")
-    return render_template_string(form_template, today=today)
+    now = datetime.datetime.now()
+    page = _form_page(now.strftime("%d/%m/%Y"))
+    encoding = request.accept_encodings.best_match(
+        [coding for coding in ("br", "gzip") if coding in page], default="identity"
+    )
+    response = Response(page[encoding], mimetype="text/html")
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    # Each encoding is a different representation, so it gets its own tag
+    response.set_etag(f"{page['etag']}-{encoding}")
+    # Fresh until the date in the form goes stale at midnight
+    midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    response.cache_control.public = True
+    response.cache_control.max_age = int((midnight - now).total_seconds())
+    return response.make_conditional(request)
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or "unknown"
+    METRICS.observe("http_request_seconds", time.perf_counter() - g.started, endpoint=endpoint)
+    METRICS.inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+    METRICS.save()
+    return response
 
 @app.route('/generate-invoice', methods=['POST'])
 def generate_invoice():
-    company_info = {
-        "name": request.form.get("company_name", ""),
-        "address": request.form.get("company_address", ""),
-        "phone": request.form.get("company_phone", ""),
-        "email": request.form.get("company_email", ""),
-        "nif": request.form.get("company_nif", "")
-    }
-
-    client_info = {
-        "name": request.form.get("client_name", ""),
-        "address": request.form.get("client_address", ""),
-        "nif": request.form.get("client_nif", "")
-    }
-
-    invoice_data = {
-        "invoice_number": request.form.get("invoice_number", ""),
-        "invoice_date": request.form.get("invoice_date", ""),
-        "payment_method": request.form.get("payment_method", ""),
-        "additional_info": "Payment for this invoice can be made by bank transfer."
-    }
+    if app.config["PROFILING"] and request.args.get("profile"):
+        # Answers with collapsed stacks for flamegraph.pl instead of the PDF.
+        # Skips the render cache so there is always a render to look at.
+        with SamplingProfiler() as profile:
+            with METRICS.stage("parse"):
+                invoice = invoice_from_form(request.form)
+            create_pdf(invoice)
+        return Response(profile.folded(), mimetype="text/plain")
+
+    with METRICS.stage("parse"):
+        invoice = _invoice_from_form(request.form)
+    _number(invoice, request.form.get("invoice_series"))
+    return _pdf_response(invoice)
+
+def _invoice_from_form(form):
+    invoice = invoice_from_form(form)
+    # An unknown tax region or currency fails here rather than mid-render
+    TAX.for_invoice(invoice)
+    return invoice
+
+@app.errorhandler(InvalidInvoice)
+def invalid_invoice(e):
+    return Response(f"Invalid invoice: {e}\n", status=400, mimetype="text/plain")
+
+def _number(invoice, series=None):
+    if LEDGER is not None and not invoice.header.invoice_number:
+        with METRICS.stage("numbering"):
+            LEDGER.issue(invoice, series or app.config["NUMBERING_SERIES"])
+
+def _pdf_response(invoice):
+    if len(invoice.items) >= app.config["STREAM_MIN_ITEMS"]:
+        chunks = iter_pdf(invoice)
+        if ARCHIVE is not None:
+            chunks = ARCHIVE.storing(invoice, chunks)
+        return Response(
+            chunks,
+            mimetype="application/pdf",
+            headers={"Content-Disposition": "attachment; filename=invoice.pdf"},
+        )
+    key, data = _render(invoice)
+    response = send_file(io.BytesIO(data), as_attachment=True, download_name="invoice.pdf", mimetype="application/pdf", etag=key)
+    if PDF_CACHE.directory:
+        response.headers["Content-Location"] = url_for("download_invoice", key=key)
+    return response
+
+@app.route('/api/invoices', methods=['POST'])
+def api_create_invoice():
+    """One invoice as a JSON document (see schema.py). The response follows
+    Accept: the PDF itself (the default), or application/json for the PDF
+    base64-encoded in an envelope. With "Prefer: respond-async" the invoice
+    is queued as a job and the answer is the job's status, as from /jobs."""
+    if request.mimetype != "application/json":
+        return jsonify(error="Content-Type must be application/json"), 415
+    respond_async = "respond-async" in request.headers.get("Prefer", "")
+    if respond_async:
+        media = "application/json"
+    elif not request.accept_mimetypes:
+        media = "application/pdf"
+    else:
+        media = request.accept_mimetypes.best_match(["application/pdf", "application/json"])
+        if media is None:
+            return jsonify(error="Acceptable types: application/pdf, application/json"), 406
 
     try:
-        qty = float(request.form.get("item_qty", "0"))
-        price = float(request.form.get("item_price", "0"))
-    except ValueError:
-        qty = 0
-        price = 0
-
-    items = [{
-        "description": request.form.get("item_description", ""),
-        "qty": qty,
-        "price": price
-    }]
-
-    pdf_buffer = create_pdf(company_info, client_info, invoice_data, items)
-    return send_file(pdf_buffer, as_attachment=True, download_name="invoice.pdf", mimetype="application/pdf")
-
-def create_pdf(company_info, client_info, invoice_data, items):
-    class InvoicePDF(FPDF):
-        def header(self):
-            # Load Unicode fonts for euro symbol
-            self.add_font('DejaVu', '', 'DejaVuSans.ttf', uni=True)
-            self.add_font('DejaVu', 'B', 'DejaVuSans-Bold.ttf', uni=True)
-            self.set_fill_color(0, 51, 102)  # Dark blue
-            self.rect(0, 0, 210, 30, 'F')
-            self.set_text_color(255, 255, 255)
-            self.set_font('DejaVu', 'B', 16)
-            self.cell(0, 20, "INVOICE", ln=True, align='C')
-            self.ln(10)
-            self.set_text_color(0, 0, 0)  # Reset text color
-
-        def footer(self):
-            self.set_y(-15)
-            self.set_font('DejaVu', '', 8)
-            self.cell(0, 10, f"Page {self.page_no()}/{{nb}}", 0, 0, 'C')
-
-    pdf = InvoicePDF()
-    pdf.alias_nb_pages()
-    pdf.add_page()
-    pdf.set_auto_page_break(auto=True, margin=15)
-
-    # -- Company Info --
-    pdf.set_font("DejaVu", "B", 12)
-    pdf.cell(80, 5, company_info["name"], ln=True)
-    pdf.set_font("DejaVu", "", 12)
-    pdf.multi_cell(80, 5, company_info["address"])
-    # Remove phone here (avoid duplication)
-    pdf.cell(80, 5, f"Email: {company_info['email']}", ln=True)
-    pdf.cell(80, 5, f"Tax ID: {company_info['nif']}", ln=True)
-    pdf.ln(5)
-
-    # -- Invoice Info --
-    pdf.set_font("DejaVu", "B", 12)
-    pdf.cell(40, 5, "Invoice #: ", align="L")
-    pdf.set_font("DejaVu", "", 12)
-    pdf.cell(60, 5, invoice_data["invoice_number"], ln=False)
-
-    pdf.set_font("DejaVu", "B", 12)
-    pdf.cell(40, 5, "Date: ", align="L")
-    pdf.set_font("DejaVu", "", 12)
-    pdf.cell(40, 5, invoice_data["invoice_date"], ln=True)
-
-    # Phone
-    pdf.set_font("DejaVu", "B", 12)
-    pdf.cell(40, 5, "Phone: ", align="L")
-    pdf.set_font("DejaVu", "", 12)
-    pdf.cell(60, 5, company_info["phone"], ln=False)
-
-    # Payment Method (with 2 spaces)
-    pdf.set_font("DejaVu", "B", 12)
-    pdf.cell(40, 5, "Payment Method:  ", align="L")  # 2 spaces
-    pdf.set_font("DejaVu", "", 12)
-    pdf.cell(40, 5, invoice_data["payment_method"], ln=True)
-
-    # Add 3 enters
-    pdf.ln(3)
-    pdf.ln(3)
-    pdf.ln(3)
-
-    # Draw separation line
-    pdf.set_draw_color(0, 0, 0)
-    pdf.set_line_width(0.5)
-    current_y = pdf.get_y()
-    pdf.line(10, current_y, 200, current_y)
-
-    # Add 3 enters again
-    pdf.ln(6)
-    pdf.ln(6)
-    pdf.ln(6)
-
-    # -- Table Header --
-    pdf.set_fill_color(200, 200, 200)
-    pdf.set_font("DejaVu", "B", 12)
-    pdf.cell(80, 8, "Description", border=1, align='C', fill=True)
-    pdf.cell(30, 8, "Qty", border=1, align='C', fill=True)
-    pdf.cell(40, 8, "Unit Price", border=1, align='C', fill=True)
-    pdf.cell(40, 8, "Amount", border=1, align='C', fill=True)
-    pdf.ln(8)
-
-    # -- Items --
-    pdf.set_font("DejaVu", "", 12)
-    subtotal = 0.0
-    vat_rate = 0.21  # 21% VAT
-    for item in items:
-        description = item["description"]
-        qty = item["qty"]
-        price = item["price"]
-        line_total = qty * price
-        subtotal += line_total
-
-        pdf.cell(80, 8, description, border=1)
-        pdf.cell(30, 8, f"{qty}", border=1, align='C')
-        pdf.cell(40, 8, f"{price:.2f} €", border=1, align='R')
-        pdf.cell(40, 8, f"{line_total:.2f} €", border=1, align='R')
-        pdf.ln(8)
-
-    # -- Totals --
-    vat_amount = subtotal * vat_rate
-    total = subtotal + vat_amount
-
-    pdf.ln(5)
-    pdf.cell(150, 8, "Subtotal:", align='R')
-    pdf.cell(40, 8, f"{subtotal:.2f} €", align='R', ln=True)
-    pdf.cell(150, 8, f"VAT ({int(vat_rate*100)}%):", align='R')
-    pdf.cell(40, 8, f"{vat_amount:.2f} €", align='R', ln=True)
-    pdf.ln(5)
-    pdf.set_font("DejaVu", "B", 12)
-    pdf.cell(150, 8, "Total Due:", align='R')
-    pdf.cell(40, 8, f"{total:.2f} €", align='R', ln=True)
-    pdf.ln(10)
-
-    pdf.set_font("DejaVu", "", 10)
-    pdf.multi_cell(0, 5, invoice_data["additional_info"])
-
-    pdf_buffer = io.BytesIO()
-    pdf.output(pdf_buffer)
-    pdf_buffer.seek(0)
-    return pdf_buffer
+        with METRICS.stage("parse"):
+            invoice = invoice_from_json(request.get_data())
+    except InvalidDocument as e:
+        errors = [{"path": path, "message": message} for path, message in e.errors]
+        return jsonify(error="invalid invoice document", errors=errors), 400
+    _number(invoice, request.args.get("series"))
+
+    if respond_async:
+        job_id = JOBS.submit("pdf", render_invoice_file, _render_cached, invoice)
+        response = jsonify(_job_status(JOBS.get(job_id)))
+        response.status_code = 202
+        response.headers["Location"] = url_for("job_status", job_id=job_id)
+        response.headers["Preference-Applied"] = "respond-async"
+        return response
+    if media == "application/pdf":
+        response = _pdf_response(invoice)
+    else:
+        key, data = _render(invoice)
+        envelope = {
+            "invoice_number": invoice.header.invoice_number,
+            "content_type": "application/pdf",
+            "size": len(data),
+            "pdf": base64.b64encode(data).decode("ascii"),
+        }
+        if PDF_CACHE.directory:
+            envelope["url"] = url_for("download_invoice", key=key)
+        response = jsonify(envelope)
+        response.set_etag(key)
+    response.vary.add("Accept")
+    return response
+
+@app.route('/invoices/<key>.pdf')
+def download_invoice(key):
+    # Re-download by content key; send_file answers If-None-Match with a 304
+    if not re.fullmatch(r"[0-9a-f]{64}", key):
+        abort(404)
+    data = PDF_CACHE.get(key)
+    if data is None:
+        abort(404)
+    return send_file(io.BytesIO(data), as_attachment=True, download_name="invoice.pdf", mimetype="application/pdf", etag=key)
+
+def _total_cents(text, rounding):
+    cents = Decimal(text).scaleb(2)
+    if not cents.is_finite():
+        raise ValueError(text)
+    cents = int(cents.to_integral_value(rounding))
+    # The index stores cents as SQLite's int64
+    if not -2 ** 63 <= cents < 2 ** 63:
+        raise ValueError(text)
+    return cents
+
+@app.route('/archive')
+def search_archive():
+    """Archived invoices as JSON. Query parameters, all optional and
+    combined: number, nif, name (prefix), from and to (YYYY-MM-DD),
+    currency (e.g. EUR), min_total and max_total (in that currency, which
+    they require), limit (1 to 1000)."""
+    if ARCHIVE is None:
+        abort(404)
+    args = request.args
+    try:
+        dates = [
+            datetime.date.fromisoformat(args[name]).isoformat() if args.get(name) else None
+            for name in ("from", "to")
+        ]
+        # Rounded inwards to whole cents: a minimum of 1.005 means 1.01
+        totals = [
+            _total_cents(args[name], rounding) if args.get(name) else None
+            for name, rounding in (("min_total", ROUND_CEILING), ("max_total", ROUND_FLOOR))
+        ]
+        limit = int(args.get("limit", 100))
+        # SQLite takes a negative LIMIT as no limit at all
+        if not 1 <= limit <= 1000:
+            raise ValueError
+    except (ValueError, InvalidOperation):
+        return jsonify(error="from/to must be YYYY-MM-DD, totals numbers and limit from 1 to 1000"), 400
+    currency = args.get("currency", "").upper() or None
+    if currency is None and totals != [None, None]:
+        # Amounts in different currencies do not compare
+        return jsonify(error="min_total/max_total need a currency"), 400
+    with METRICS.stage("archive_search"):
+        rows = ARCHIVE.search(
+            number=args.get("number"), nif=args.get("nif"), name=args.get("name"),
+            date_from=dates[0], date_to=dates[1], currency=currency,
+            total_min=totals[0], total_max=totals[1], limit=limit,
+        )
+    invoices = [
+        {
+            "invoice_number": row["invoice_number"],
+            "client_nif": row["client_nif"],
+            "client_name": row["client_name"],
+            "invoice_date": row["invoice_date"],
+            "currency": row["currency"],
+            "total": str(Decimal(row["total_cents"]).scaleb(-2)),
+            "size": row["size"],
+            "url": url_for("archived_invoice", digest=row["digest"]),
+        }
+        for row in rows
+    ]
+    return jsonify(invoices=invoices)
+
+@app.route('/archive/<digest>.pdf')
+def archived_invoice(digest):
+    # Sent from the file itself: under gunicorn that is a sendfile(), with
+    # no copy of the PDF through Python
+    if ARCHIVE is None or not re.fullmatch(r"[0-9a-f]{64}", digest):
+        abort(404)
+    try:
+        return send_file(ARCHIVE.path(digest), as_attachment=True, download_name="invoice.pdf",
+                         mimetype="application/pdf", etag=digest, max_age=31536000)
+    except FileNotFoundError:
+        abort(404)
+
+@app.route('/generate-invoices', methods=['POST'])
+def generate_invoices():
+    upload = request.files.get("file")
+    if upload is None:
+        return "Missing 'file' upload (CSV or JSON Lines)", 400
+    fmt = request.form.get("format") or detect_format(upload.filename)
+    if fmt not in ("csv", "jsonl"):
+        return "Unsupported batch format, use CSV or JSON Lines", 400
+
+    # Request teardown closes every upload before a streamed body is sent,
+    # so the response takes over the upload's stream and closes it itself.
+    stream, upload.stream = upload.stream, io.BytesIO()
+    return Response(
+        _stream_batch(stream, fmt, app.config["BATCH_WORKERS"]),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=invoices.zip"},
+    )
+
+def _stream_batch(stream, fmt, workers):
+    # Each PDF goes out as soon as it is rendered; nothing is buffered
+    # beyond the invoice in flight, whatever the batch size.
+    with io.TextIOWrapper(stream, encoding="utf-8", newline="") as lines:
+        yield from stream_zip(_number_batch(read_invoices(lines, fmt)), workers)
+
+def _number_batch(invoices):
+    if LEDGER is None:
+        return invoices
+    return number_invoices(invoices, LEDGER, app.config["NUMBERING_SERIES"])
+
+def _render(invoice):
+    with METRICS.stage("cached_render"):
+        key, data = PDF_CACHE.render(create_pdf, invoice)
+    if ARCHIVE is not None:
+        with METRICS.stage("archive"):
+            ARCHIVE.store(invoice, data)
+    return key, data
+
+def _render_cached(invoice):
+    return _render(invoice)[1]
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    # Same inputs as /generate-invoice (form fields) or /generate-invoices
+    # (a 'file' upload), rendered in the background instead of in-request.
+    upload = request.files.get("file")
+    if upload is None:
+        invoice = _invoice_from_form(request.form)
+        _number(invoice, request.form.get("invoice_series"))
+        job_id = JOBS.submit("pdf", render_invoice_file, _render_cached, invoice)
+    else:
+        fmt = request.form.get("format") or detect_format(upload.filename)
+        if fmt not in ("csv", "jsonl"):
+            return "Unsupported batch format, use CSV or JSON Lines", 400
+        input_path = spool_upload(upload, JOBS.directory)
+        job_id = JOBS.submit("zip", functools.partial(render_batch_file, prepare=_number_batch), input_path, fmt)
+    response = jsonify(_job_status(JOBS.get(job_id)))
+    response.status_code = 202
+    response.headers["Location"] = url_for("job_status", job_id=job_id)
+    return response
+
+def _job_status(job):
+    status = {"id": job["id"], "kind": job["kind"], "status": job["status"]}
+    if job["status"] == "done":
+        status["download_url"] = url_for("download_job", job_id=job["id"])
+    elif job["status"] == "failed":
+        status["error"] = job["error"]
+    return status
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(_job_status(job))
+
+@app.route('/jobs/<job_id>/download')
+def download_job(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    if job["status"] != "done":
+        return jsonify(_job_status(job)), 409
+    path = JOBS.path(job["id"], job["kind"])
+    if job["kind"] == "zip":
+        return send_file(path, as_attachment=True, download_name="invoices.zip", mimetype="application/zip")
+    return send_file(path, as_attachment=True, download_name="invoice.pdf", mimetype="application/pdf")
+
+@app.route('/healthz')
+def healthz():
+    return "ok"
+
+@app.route('/readyz')
+def readyz():
+    # Fonts and the page chrome are loaded at import; what can still fail
+    # is a database on a full, missing or read-only disk
+    for name, store in (("jobs", JOBS), ("ledger", LEDGER), ("archive", ARCHIVE)):
+        if store is not None and not store.ready():
+            return f"{name} database unavailable", 503
+    return "ready"
+
+@app.route('/metrics')
+def metrics():
+    # Streamed responses are counted when their headers go out, so
+    # http_request_seconds leaves out the time spent sending their body
+    jobs = {(("status", status),): count for status, count in JOBS.counts().items()}
+    body = METRICS.render(extra=[("invoice_jobs", "Background jobs by status", jobs)])
+    return Response(body, mimetype="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    from serve import main
+    main(application=app)
@@ -0,0 +1,151 @@
+"""Archive of issued invoices, for sending one again without re-rendering.
+
+PDFs are stored by the SHA-256 of their bytes under objects/ab/<digest>.pdf,
+so an invoice rendered twice is stored once. A SQLite index next to them
+maps invoice number, client NIF, client name, date, currency and total
+to the digest. Each search is a range scan on one of its indexes, so lookups such
+as every invoice for one NIF in a quarter stay in the milliseconds however
+large the archive grows. Files are served from their path, which lets the
+server send them with sendfile().
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+from storage import ThreadConnections, atomic_write
+from tax import TAX
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    invoice_number TEXT NOT NULL,
+    client_nif TEXT NOT NULL,
+    client_name TEXT NOT NULL COLLATE NOCASE,
+    invoice_date TEXT,
+    currency TEXT NOT NULL,
+    total_cents INTEGER NOT NULL,
+    archived REAL NOT NULL,
+    UNIQUE (invoice_number, digest)
+);
+CREATE INDEX IF NOT EXISTS invoices_number ON invoices (invoice_number);
+CREATE INDEX IF NOT EXISTS invoices_nif_date ON invoices (client_nif, invoice_date);
+CREATE INDEX IF NOT EXISTS invoices_name_date ON invoices (client_name, invoice_date);
+CREATE INDEX IF NOT EXISTS invoices_date ON invoices (invoice_date);
+CREATE INDEX IF NOT EXISTS invoices_currency_total ON invoices (currency, total_cents);
+"""
+
+COLUMNS = (
+    "digest", "size", "invoice_number", "client_nif", "client_name", "invoice_date", "currency", "total_cents",
+    "archived",
+)
+
+
+class Archive:
+    def __init__(self, directory):
+        self.directory = directory
+        self._objects = os.path.join(directory, "objects")
+        os.makedirs(self._objects, exist_ok=True)
+        self._db = ThreadConnections(
+            os.path.join(directory, "index.sqlite3"), setup=["PRAGMA synchronous=NORMAL"], row_factory=sqlite3.Row,
+        )
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'invoices'").fetchone() and not any(
+                row["name"] == "currency" for row in db.execute("PRAGMA table_info(invoices)")
+            ):
+                # Indexes from before currencies: every invoice was in euros
+                db.execute("ALTER TABLE invoices ADD COLUMN currency TEXT NOT NULL DEFAULT 'EUR'")
+                db.execute("DROP INDEX IF EXISTS invoices_total")
+            db.executescript(SCHEMA)
+
+    def ready(self):
+        return self._db.ready()
+
+    def path(self, digest):
+        return os.path.join(self._objects, digest[:2], f"{digest}.pdf")
+
+    def store(self, invoice, data, totals=None):
+        """Archive PDF bytes rendered from invoice; returns their digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            with atomic_write(path) as f:
+                f.write(data)
+        self._index(invoice, digest, len(data), totals)
+        return digest
+
+    def storing(self, invoice, chunks, totals=None):
+        """Pass chunks through, archiving them once the last one is out.
+
+        For streamed responses: nothing is kept if the consumer stops early.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        # Named once the digest is known; the same bytes replace themselves
+        with atomic_write(lambda: self.path(digest.hexdigest()), directory=self._objects) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                yield chunk
+        self._index(invoice, digest.hexdigest(), size, totals)
+
+    def _index(self, invoice, digest, size, totals):
+        totals = totals or TAX.totals(invoice)
+        _, currency = TAX.for_invoice(invoice)
+        # Stored ISO so date ranges compare as text
+        date = invoice.header.date()
+        with self._db() as db:
+            db.execute(
+                f"INSERT OR IGNORE INTO invoices ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                (
+                    digest, size, invoice.header.invoice_number, invoice.client.nif, invoice.client.name,
+                    date and date.isoformat(), currency.code, int(totals["total"] * 100), time.time(),
+                ),
+            )
+
+    def search(self, number=None, nif=None, name=None, date_from=None, date_to=None,
+               currency=None, total_min=None, total_max=None, limit=100):
+        """Archived invoices matching every criterion given, by date.
+
+        name matches as a case-insensitive prefix; dates are ISO and both
+        ends inclusive; totals are in cents of currency, which they
+        require. Returns dicts of COLUMNS.
+        """
+        if currency is None and (total_min is not None or total_max is not None):
+            raise ValueError("a total range needs a currency")
+        where = []
+        params = []
+        if number is not None:
+            where.append("invoice_number = ?")
+            params.append(number)
+        if nif is not None:
+            where.append("client_nif = ?")
+            params.append(nif)
+        if name:
+            # A range rather than LIKE, so the NOCASE index is always usable
+            where.append("client_name >= ? AND client_name < ?")
+            params += [name, name + "\U0010ffff"]
+        if date_from is not None:
+            where.append("invoice_date >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            where.append("invoice_date <= ?")
+            params.append(date_to)
+        if currency is not None:
+            where.append("currency = ?")
+            params.append(currency)
+        if total_min is not None:
+            where.append("total_cents >= ?")
+            params.append(total_min)
+        if total_max is not None:
+            where.append("total_cents <= ?")
+            params.append(total_max)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM invoices"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY invoice_date, id LIMIT ?"
+        return [dict(row) for row in self._db().execute(sql, (*params, limit))]
@@ -0,0 +1,262 @@
+import argparse
+import collections
+import csv
+import io
+import os
+import re
+import sys
+import zipfile
+
+from model import InvalidInvoice, Items
+from parallel import render_one, render_parallel
+from render import invoice_from_form, item_from_form
+from schema import invoice_from_json
+from tax import TAX
+
+FORMATS = {
+    ".csv": "csv",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+    ".json": "jsonl",
+}
+
+
+class BadRecord(ValueError):
+    pass
+
+
+def detect_format(filename):
+    return FORMATS.get(os.path.splitext(filename or "")[1].lower())
+
+
+def read_invoices(lines, fmt):
+    if fmt == "csv":
+        return read_csv(lines)
+    if fmt == "jsonl":
+        return read_jsonl(lines)
+    raise ValueError(f"Unsupported batch format: {fmt}")
+
+
+def read_csv(lines):
+    # Same column names as the HTML form, one row per line item.
+    # Consecutive rows sharing an invoice_ref, or where that is blank an
+    # invoice_number, make up one invoice. A row with neither is an invoice
+    # of its own: rows left for the ledger to number are separate invoices.
+    # An invoice with an unknown tax region or currency, or a row that
+    # cannot be billed, is reported as a BadRecord and the rest of its rows
+    # are skipped.
+    invoice = None
+    key = None
+    reader = csv.DictReader(lines, restval="")
+    for row in reader:
+        row_key = row.get("invoice_ref") or row.get("invoice_number") or ""
+        try:
+            if not row_key or row_key != key:
+                if invoice is not None:
+                    yield invoice
+                key = row_key
+                invoice = invoice_from_form(row, items=Items())
+                region, _ = TAX.for_invoice(invoice)
+            if invoice is not None:
+                invoice.items.append(**item_from_form(row, region.rates))
+        except InvalidInvoice as e:
+            invoice = None
+            yield BadRecord(f"line {reader.line_num}: {e}")
+    if invoice is not None:
+        yield invoice
+
+
+def read_jsonl(lines):
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line:
+            # Validated as POST /api/invoices validates a document
+            try:
+                yield invoice_from_json(line)
+            except InvalidInvoice as e:
+                yield BadRecord(f"line {number}: {e}")
+
+
+def number_invoices(invoices, ledger, series=""):
+    """Give invoices without a number the next ones from ledger, in input
+    order. One that cannot be issued is passed on as a BadRecord."""
+    for invoice in invoices:
+        if not isinstance(invoice, Exception) and not invoice.header.invoice_number:
+            try:
+                ledger.issue(invoice, series)
+            except InvalidInvoice as e:
+                invoice = BadRecord(str(e))
+        yield invoice
+
+
+def pdf_name(index, invoice_number):
+    number = re.sub(r"[^0-9A-Za-z._-]+", "-", invoice_number).strip("-.")
+    return f"{index:06d}_{number or 'invoice'}.pdf"
+
+
+def render_all(invoices, workers=1):
+    invoices = iter(invoices)
+    names = collections.deque()
+
+    def named():
+        for index, invoice in enumerate(invoices, 1):
+            number = "" if isinstance(invoice, Exception) else invoice.header.invoice_number
+            names.append(pdf_name(index, number))
+            yield invoice
+
+    if workers > 1:
+        results = render_parallel(named(), workers)
+    else:
+        results = map(render_one, named())
+    # Results come back in input order, names were queued in the same order
+    for data, error in results:
+        yield names.popleft(), data, error
+
+
+def _errors_report(errors):
+    return "".join(f"{name}\t{error}\n" for name, error in errors)
+
+
+class _ChunkSink(io.RawIOBase):
+    # Unseekable, so zipfile writes data descriptors and never seeks back
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _zip_entries(archive, invoices, workers, errors):
+    # PDF streams are already deflated, so entries are stored as-is
+    for name, data, error in render_all(invoices, workers):
+        if error is not None:
+            errors.append((name, error))
+            continue
+        archive.writestr(name, data, zipfile.ZIP_STORED)
+        yield name
+    if errors:
+        archive.writestr("errors.txt", _errors_report(errors))
+
+
+def write_zip(invoices, fileobj, workers=1):
+    errors = []
+    with zipfile.ZipFile(fileobj, "w", zipfile.ZIP_STORED) as archive:
+        count = sum(1 for _ in _zip_entries(archive, invoices, workers, errors))
+    return count, errors
+
+
+def stream_zip(invoices, workers=1):
+    """Yield a ZIP archive chunk by chunk, one chunk per rendered invoice."""
+    errors = []
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as archive:
+        for _ in _zip_entries(archive, invoices, workers, errors):
+            yield sink.drain()
+    yield sink.drain()
+
+
+def write_dir(invoices, path, workers=1):
+    count = 0
+    errors = []
+    os.makedirs(path, exist_ok=True)
+    for name, data, error in render_all(invoices, workers):
+        if error is not None:
+            errors.append((name, error))
+            continue
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(data)
+        count += 1
+    if errors:
+        with open(os.path.join(path, "errors.txt"), "w", encoding="utf-8") as f:
+            f.write(_errors_report(errors))
+    return count, errors
+
+
+def write_combined(invoices, fileobj, **options):
+    """All valid invoices as sections of a single PDF, rendered in this
+    process. options go to render.write_combined_pdf."""
+    from render import write_combined_pdf
+    count = 0
+    errors = []
+
+    def valid():
+        nonlocal count
+        for index, invoice in enumerate(invoices, 1):
+            if isinstance(invoice, Exception):
+                errors.append((pdf_name(index, ""), str(invoice)))
+                continue
+            count += 1
+            yield invoice
+
+    write_combined_pdf(valid(), fileobj, **options)
+    return count, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a batch of invoices to PDF.")
+    parser.add_argument("input", help="CSV or JSON Lines file of invoices, '-' for stdin")
+    parser.add_argument("-o", "--output", required=True,
+                        help="ZIP file (*.zip), single combined PDF (*.pdf) or directory to write to")
+    parser.add_argument("-f", "--format", choices=sorted(set(FORMATS.values())),
+                        help="input format (default: guessed from the file extension)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes to render with (default: one per CPU)")
+    parser.add_argument("--ledger", help="numbering ledger (SQLite) for invoices without a number")
+    parser.add_argument("--series", default="", help="number series to issue from (default: none)")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9",
+                        help="combined PDF only: zlib level for every stream (default: zlib's own, 6)")
+    parser.add_argument("--object-streams", action="store_true",
+                        help="combined PDF only: pack objects and the cross-reference table into compressed streams")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or detect_format(args.input)
+    if fmt is None:
+        parser.error("cannot guess the input format, pass --format")
+
+    if args.input == "-":
+        lines = sys.stdin
+    else:
+        lines = open(args.input, encoding="utf-8", newline="")
+    ledger = None
+    if args.ledger:
+        from numbering import Ledger
+        # Numbers are issued here, before rendering, so workers never wait on the ledger
+        ledger = Ledger(args.ledger, block_size=256, flush_every=256)
+    try:
+        with lines:
+            invoices = read_invoices(lines, fmt)
+            if ledger is not None:
+                invoices = number_invoices(invoices, ledger, args.series)
+            if args.output.lower().endswith(".zip"):
+                with open(args.output, "wb") as f:
+                    count, errors = write_zip(invoices, f, args.workers)
+            elif args.output.lower().endswith(".pdf"):
+                with open(args.output, "wb") as f:
+                    count, errors = write_combined(
+                        invoices, f, compress_level=args.compress_level, object_streams=args.object_streams,
+                    )
+            else:
+                count, errors = write_dir(invoices, args.output, args.workers)
+    finally:
+        # Hand unused numbers back even if the batch failed
+        if ledger is not None:
+            ledger.close()
+    print(f"Wrote {count} invoices to {args.output}")
+    for name, error in errors:
+        print(f"{name}: {error}", file=sys.stderr)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""Benchmarks for create_pdf and the HTTP endpoints.
+
+    python benchmark.py                      # run everything, print a table
+    python benchmark.py --json results.json  # also write machine-readable results
+    python benchmark.py --compare results.json --threshold 0.15
+    python benchmark.py --only archive --archive-rows 1000000
+
+--compare exits non-zero when any case's mean latency regressed by more
+than --threshold against an earlier --json run.
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+from loadtest import FORM, percentile
+
+ITEM_COUNTS = (1, 10, 100, 1000, 10000)
+# The million-row archive takes most of a minute to fill, so it is opt-in
+ARCHIVE_ROWS = 50000
+
+
+def sample_invoice(n_items, number="2025/05"):
+    from model import Items
+    from render import invoice_from_form
+    invoice = invoice_from_form(dict(FORM, invoice_number=number))
+    invoice.items = Items()
+    for i in range(n_items):
+        invoice.items.append(f"Electrical Installation #{i + 1}", 1 + i % 5, 465.0 + i % 100)
+    return invoice
+
+
+def measure(name, fn, repeat, warmup=1, **extra):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    size = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+        if isinstance(result, (bytes, bytearray)):
+            size = len(result)
+    # One extra traced run: tracemalloc slows the code down, so it is kept
+    # out of the timings above
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    total = sum(timings)
+    case = {
+        "name": name,
+        "runs": repeat,
+        "mean_ms": round(total / repeat * 1000, 3),
+        "stdev_ms": round(statistics.pstdev(timings) * 1000, 3),
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p90_ms": round(percentile(timings, 90) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "per_sec": round(repeat / total, 2),
+        "peak_mem_kb": round(peak / 1024, 1),
+        "output_bytes": size,
+    }
+    case.update(extra)
+    return case
+
+
+class _NullSink:
+    def write(self, data):
+        return len(data)
+
+
+def bench_create_pdf(repeat):
+    from render import create_pdf, write_pdf
+    cases = []
+    for n in ITEM_COUNTS:
+        invoice = sample_invoice(n)
+        pages = create_pdf(invoice).getvalue().count(b"/Type /Page\n")
+        runs = max(3, repeat // max(1, n // 10))
+        cases.append(measure(
+            f"create_pdf/{n}_items", lambda: create_pdf(invoice).getvalue(), runs,
+            items=n, pages=pages,
+        ))
+        if n >= 1000:
+            # Page-at-a-time output: compare peak_mem_kb with the case above
+            cases.append(measure(
+                f"write_pdf/{n}_items", lambda: write_pdf(invoice, _NullSink()), runs,
+                items=n, pages=pages,
+            ))
+    return cases
+
+
+def bench_combined(repeat, count=200):
+    # One print-run PDF against the same invoices rendered one by one
+    from render import create_pdf, write_combined_pdf
+    invoices = [sample_invoice(3, number=f"RUN/{i}") for i in range(count)]
+    sink = _NullSink()
+    size = write_combined_pdf(invoices, sink)
+    separate = sum(len(create_pdf(invoice).getvalue()) for invoice in invoices)
+    runs = max(2, repeat // 10)
+    return [
+        measure(f"combined/{count}_invoices", lambda: write_combined_pdf(invoices, sink), runs,
+                output_bytes=size),
+        measure(f"combined/{count}_invoices_separately",
+                lambda: [create_pdf(invoice).getvalue() for invoice in invoices], runs,
+                output_bytes=separate),
+    ]
+
+
+def bench_output(repeat, count=100):
+    # Size against CPU at every zlib level, with and without object and
+    # cross-reference streams: one long invoice, and a print run as it
+    # would be archived in bulk
+    from render import write_combined_pdf, write_pdf
+    invoice = sample_invoice(100)
+    run = [sample_invoice(3, number=f"RUN/{i}") for i in range(count)]
+    cases = []
+    for level in range(10):
+        for object_streams in (False, True):
+            suffix = f"level{level}" + ("_objstm" if object_streams else "")
+            options = {"compress_level": level, "object_streams": object_streams}
+            size = write_pdf(invoice, _NullSink(), **options)
+            cases.append(measure(f"output/100_items_{suffix}", lambda: write_pdf(invoice, _NullSink(), **options),
+                                 max(2, repeat // 4), output_bytes=size, **options))
+            size = write_combined_pdf(run, _NullSink(), **options)
+            cases.append(measure(f"output/{count}_invoices_{suffix}",
+                                 lambda: write_combined_pdf(run, _NullSink(), **options),
+                                 max(2, repeat // 10), output_bytes=size, **options))
+    return cases
+
+
+def bench_archive(repeat, count=ARCHIVE_ROWS):
+    # Index lookups over a large archive, filled directly without PDFs:
+    # 200 invoices per client over three years. Rows are generated as
+    # SQLite inserts them, so memory stays flat at any count.
+    import datetime
+    import random
+    from archive import COLUMNS, Archive
+    random.seed(0)
+    start = datetime.date(2023, 1, 1)
+    with tempfile.TemporaryDirectory() as directory:
+        archive = Archive(directory)
+        nifs = [f"{i:08d}{chr(65 + i % 23)}" for i in range(count // 200)]
+
+        def rows():
+            for i in range(count):
+                date = start + datetime.timedelta(days=random.randrange(3 * 365))
+                client = random.randrange(len(nifs))
+                yield (
+                    f"{i:064x}", 14000, f"A{date.year}/{i:07d}", nifs[client], f"Client {client:06d}",
+                    date.isoformat(), "EUR", random.randrange(100, 1000000), 0.0,
+                )
+
+        with archive._db() as db:
+            db.executemany(f"INSERT INTO invoices ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows())
+            number, nif = db.execute(
+                "SELECT invoice_number, client_nif FROM invoices WHERE digest = ?", (f"{count // 2:064x}",)
+            ).fetchone()
+        invoice = sample_invoice(3, number="A2025/9999999")
+        return [
+            measure("archive/store", lambda: archive.store(invoice, os.urandom(14000)), repeat),
+            measure(f"archive/{count}_by_number", lambda: archive.search(number=number), repeat),
+            measure(f"archive/{count}_nif_quarter",
+                    lambda: archive.search(nif=nif, date_from="2025-01-01", date_to="2025-03-31"), repeat),
+            measure(f"archive/{count}_name_prefix",
+                    lambda: archive.search(name="client 0001", limit=100), repeat),
+            measure(f"archive/{count}_total_range",
+                    lambda: archive.search(currency="EUR", total_min=500000, total_max=500100), repeat),
+        ]
+
+
+def bench_money(repeat):
+    import money
+    items = sample_invoice(ITEM_COUNTS[-1]).items
+    cases = [measure(f"money/{len(items)}_items_decimal",
+                     lambda: money.compute_totals(items, use_numpy=False), repeat)]
+    if money.numpy is not None:
+        cases.append(measure(f"money/{len(items)}_items_numpy",
+                             lambda: money.compute_totals(items, use_numpy=True), repeat))
+    return cases
+
+
+def _old_invoice(record):
+    # The loose-dict shape invoices had before the model
+    return (
+        dict(record["company"]),
+        dict(record["client"]),
+        dict(record["invoice"]),
+        [dict(item) for item in record["items"]],
+    )
+
+
+def bench_memory(repeat, count=50000):
+    # A batch held in memory: JSON-decoded records turned into the old
+    # dicts or into the model. mean_ms is the build time, untraced.
+    from schema import invoice_from_document
+    line = json.dumps(sample_invoice(3).as_record())
+    cases = []
+    for name, build in (("dicts", _old_invoice), ("model", invoice_from_document)):
+        start = time.perf_counter()
+        held = [build(json.loads(line)) for _ in range(count)]
+        elapsed = time.perf_counter() - start
+        del held
+        tracemalloc.start()
+        held = [build(json.loads(line)) for _ in range(count)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del held
+        cases.append({
+            "name": f"memory/{count}_invoices_{name}",
+            "runs": 1,
+            "mean_ms": round(elapsed * 1000, 3),
+            "peak_mem_kb": round(size / 1024, 1),
+            "bytes_per_invoice": round(size / count),
+        })
+    return cases
+
+
+def bench_fonts(repeat):
+    from fpdf import FPDF
+    from font_registry import DEJAVU_FACES, FONTS, FontRegistry
+    FONTS.preload()
+    return [
+        # Cold: parse both TTF files from scratch, as every request used to
+        measure("fonts/cold_parse", lambda: FontRegistry("DejaVu", DEJAVU_FACES).preload(), max(3, repeat // 4)),
+        # Warm: hand a new document the already-parsed faces
+        measure("fonts/warm_install", lambda: FONTS.install(FPDF()), repeat * 5),
+    ]
+
+
+def _worker_memory(n_items):
+    from parallel import render_one
+    render_one(sample_invoice(n_items))
+    sizes = {}
+    with open("/proc/self/smaps_rollup", encoding="ascii") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss", "Private_Dirty"):
+                sizes[key] = int(value.split()[0])
+    return os.getpid(), sizes
+
+
+def bench_workers(repeat, workers=4):
+    # Resident memory of a render pool's workers after a few renders each;
+    # memory shared between them (mapped fonts, forked pages) counts in Rss
+    # but only pro rata in Pss. Linux only.
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        return []
+    from concurrent.futures import ProcessPoolExecutor
+    from parallel import _init_worker
+    with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+        seen = dict(pool.map(_worker_memory, [20] * workers * 4))
+    return [{
+        "name": f"workers/{workers}_workers_memory",
+        "runs": len(seen),
+        "mean_ms": 0,
+        **{f"{key.lower()}_kb": round(statistics.mean(sizes[key] for sizes in seen.values()))
+           for key in ("Rss", "Pss", "Private_Dirty")},
+    }]
+
+
+def bench_http(repeat):
+    from app import app
+    client = app.test_client()
+    counter = iter(range(10 ** 9))
+
+    def post(cached):
+        form = dict(FORM)
+        if not cached:
+            form["invoice_number"] = f"BENCH/{next(counter)}"
+        response = client.post("/generate-invoice", data=form)
+        assert response.status_code == 200, response.status
+        return response.data
+
+    return [
+        measure("http/generate-invoice", lambda: post(False), repeat),
+        measure("http/generate-invoice_cached", lambda: post(True), repeat * 5),
+    ]
+
+
+def cold_child():
+    # Runs in a fresh interpreter: import, font loading and first render
+    start = time.perf_counter()
+    from render import create_pdf
+    imported = time.perf_counter()
+    from font_registry import FONTS
+    FONTS.preload()
+    fonts = time.perf_counter()
+    create_pdf(sample_invoice(1)).getvalue()
+    rendered = time.perf_counter()
+    print(json.dumps({
+        "import_ms": round((imported - start) * 1000, 3),
+        "fonts_ms": round((fonts - imported) * 1000, 3),
+        "first_render_ms": round((rendered - fonts) * 1000, 3),
+    }))
+
+
+def import_child(module):
+    start = time.perf_counter()
+    __import__(module)
+    print(json.dumps({"import_ms": round((time.perf_counter() - start) * 1000, 3)}))
+
+
+def _child(args, font_cache_dir):
+    output = subprocess.run(
+        [sys.executable, "-W", "ignore", __file__, *args],
+        check=True, capture_output=True, text=True,
+        env=dict(os.environ, FONT_CACHE_DIR=font_cache_dir),
+    ).stdout
+    return json.loads(output)
+
+
+def _mean_case(name, runs):
+    cold = {key: round(statistics.mean(run[key] for run in runs), 3) for key in runs[0]}
+    return dict(name=name, runs=len(runs), mean_ms=round(sum(cold.values()), 3), **cold)
+
+
+def bench_cold(repeat):
+    count = max(1, repeat // 10)
+    with tempfile.TemporaryDirectory() as cache:
+        # Font metrics prebuilt, as python font_registry.py leaves them
+        subprocess.run([sys.executable, "-W", "ignore", "font_registry.py"], check=True, capture_output=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ, FONT_CACHE_DIR=cache))
+        cases = [
+            _mean_case("cold/import_render", [_child(["--import-child", "render"], cache) for _ in range(count)]),
+            _mean_case("cold/import_app", [_child(["--import-child", "app"], cache) for _ in range(count)]),
+            _mean_case("cold/import_fonts_first_render", [_child(["--cold-child"], cache) for _ in range(count)]),
+        ]
+        # No metrics cache: every run parses the TTF files
+        uncached = [_child(["--cold-child"], tempfile.mkdtemp(dir=cache)) for _ in range(count)]
+        cases.append(_mean_case("cold/import_fonts_first_render_uncached", uncached))
+    return cases
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {case["name"]: case for case in json.load(f)["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        before = baseline.get(case["name"])
+        if before is None or not before.get("mean_ms"):
+            continue
+        change = case["mean_ms"] / before["mean_ms"] - 1
+        flag = "REGRESSION" if change > threshold else ""
+        print(f"{case['name']:<36} {before['mean_ms']:>10.2f} -> {case['mean_ms']:>10.2f} ms  {change:+7.1%} {flag}")
+        if flag:
+            regressions.append(case["name"])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="timed runs per case")
+    parser.add_argument("--only", choices=("cold", "fonts", "money", "memory", "workers", "create_pdf", "combined", "output", "archive", "http"), action="append")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier --json results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--archive-rows", type=int, default=ARCHIVE_ROWS,
+                        help=f"invoices in the archive suite (default: {ARCHIVE_ROWS}; 1000000 for the full-size run)")
+    parser.add_argument("--cold-child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--import-child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    if args.cold_child:
+        cold_child()
+        return
+    if args.import_child:
+        import_child(args.import_child)
+        return
+
+    suites = {"cold": bench_cold, "fonts": bench_fonts, "money": bench_money, "memory": bench_memory, "workers": bench_workers, "create_pdf": bench_create_pdf, "combined": bench_combined, "output": bench_output, "archive": bench_archive, "http": bench_http}
+    suites["archive"] = functools.partial(bench_archive, count=args.archive_rows)
+    cases = []
+    for name in args.only or suites:
+        cases.extend(suites[name](args.repeat))
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cases": cases,
+    }
+    print(f"{'case':<36} {'mean ms':>10} {'p50':>9} {'p99':>9} {'per s':>8} {'peak KB':>9} {'bytes':>8}")
+    for case in cases:
+        print(f"{case['name']:<36} {case['mean_ms']:>10.2f} {case.get('p50_ms', 0):>9.2f} "
+              f"{case.get('p99_ms', 0):>9.2f} {case.get('per_sec', 0):>8.1f} "
+              f"{case.get('peak_mem_kb', 0):>9.1f} {case.get('output_bytes') or 0:>8}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
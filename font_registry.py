@@ -0,0 +1,332 @@
+import array
+import collections
+import copy
+import functools
+import io
+import mmap
+import os
+import pickle
+import threading
+
+import fpdf
+from fontTools import subset as ftsubset
+from fontTools import ttLib
+from fpdf import FPDF
+from fpdf.fonts import SubsetMap, TTFFont
+from fpdf.output import OutputProducer
+
+from storage import atomic_write
+
+FONT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Parsed font metrics, one file per face, written on first use like .pyc
+# files; prebuild them with python font_registry.py for read-only images
+FONT_CACHE_DIR = os.environ.get("FONT_CACHE_DIR", os.path.join(FONT_DIR, "__pycache__"))
+# Bump when the cached state of a face changes shape
+METRICS_VERSION = 2
+# Whole strings whose width each face remembers
+TEXT_WIDTH_CACHE_ENTRIES = 4096
+
+DEJAVU_FACES = {
+    "": "DejaVuSans.ttf",
+    "B": "DejaVuSans-Bold.ttf",
+}
+
+
+# Tables a PDF viewer never reads from an embedded CIDFontType2 program
+DROP_TABLES = [
+    "FFTM", "GDEF", "GPOS", "GSUB", "MATH", "hdmx", "meta", "sbix",
+    "CBDT", "CBLC", "EBDT", "EBLC", "EBSC", "SVG ", "CPAL", "COLR",
+    "kern", "DSIG", "LTSH", "PCLT", "VDMX", "gasp",
+]
+
+
+class _Widths(dict):
+    # Same lookups as fpdf's defaultdict, but a miss never writes back,
+    # so the shared width table stays read-only across threads.
+    __slots__ = ("default",)
+
+    def __init__(self, widths, default):
+        super().__init__(widths)
+        self.default = default
+
+    def __missing__(self, key):
+        return self.default
+
+
+class TextWidths:
+    """Unscaled advance widths of one face, shared by every document.
+
+    Single characters, which is how fpdf's line breaker measures, are read
+    from a flat array over the BMP. Whole strings go through an LRU, since
+    labels, names and amounts recur from one invoice to the next; widths
+    are kept in font units, so one entry serves every font size.
+    """
+
+    def __init__(self, cw, max_entries=TEXT_WIDTH_CACHE_ENTRIES):
+        self.cw = cw
+        self.advances = array.array("I", (cw[code] for code in range(0x10000)))
+        self.text = functools.lru_cache(maxsize=max_entries)(self._text)
+
+    def char(self, char):
+        code = ord(char)
+        return self.advances[code] if code < 0x10000 else self.cw[code]
+
+    def _text(self, text):
+        advances = self.advances
+        cw = self.cw
+        return sum(advances[code] if code < 0x10000 else cw[code] for code in map(ord, text))
+
+    def stats(self):
+        info = self.text.cache_info()
+        return {"entries": info.currsize, "hits": info.hits, "misses": info.misses}
+
+
+class _RegistryFont(TTFFont):
+    # fpdf's TTFFont measuring through the face's TextWidths; same sums, so
+    # the same layout to the last digit
+    __slots__ = ("widths",)
+
+    def get_text_width(self, text, font_size_pt, text_shaping_params):
+        if text_shaping_params or self.is_symbol:
+            return super().get_text_width(text, font_size_pt, text_shaping_params)
+        if font_size_pt > self.biggest_size_pt:
+            self.biggest_size_pt = font_size_pt
+        widths = self.widths
+        units = widths.char(text) if len(text) == 1 else widths.text(text)
+        return len(text), units * font_size_pt * 0.001
+
+
+class _MappedFile(io.RawIOBase):
+    # A read-only file over a shared mapping with a position of its own.
+    # Reads copy just the table asked for; BytesIO would copy the whole font.
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        data = self._view[self._position:end].tobytes()
+        self._position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _Face:
+    __slots__ = ("data", "proto", "widths")
+
+    def __init__(self, path, family, style, cache_dir=None):
+        # Mapped rather than read: the pages belong to the OS page cache, so
+        # every worker process renders from the same physical copy
+        with open(path, "rb") as f:
+            self.data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        source = (os.path.basename(path), len(self.data), os.stat(path).st_mtime_ns)
+        proto = _load_metrics(cache_dir, source)
+        if proto is None:
+            proto = _RegistryFont(FPDF(), path, f"{family.lower()}{style}", style)
+            proto.ttfont.close()
+            proto.cw = _Widths(proto.cw, proto.desc.missing_width)
+            # Rebuilt per document by instantiate()
+            proto.ttfont = proto.subset = proto.widths = None
+            _save_metrics(cache_dir, source, proto)
+        proto.ttffile = path
+        self.widths = proto.widths = TextWidths(proto.cw)
+        self.proto = proto
+
+    def instantiate(self, pdf):
+        font = copy.copy(self.proto)
+        font.i = len(pdf.fonts) + 1
+        # fpdf subsets the TTFont in place when the document is written,
+        # so every document gets its own lazy view over the shared bytes.
+        font.ttfont = ttLib.TTFont(
+            _MappedFile(self.data), recalcTimestamp=False, lazy=True
+        )
+        font._hbfont = None
+        font.biggest_size_pt = 0
+        font.missing_glyphs = []
+        font.subset = SubsetMap(font)
+        return font
+
+    def subset(self, glyph_names):
+        # Glyph names are kept so fpdf can still map the document's
+        # characters onto the subset, and hinting is dropped: PDF viewers
+        # rasterise at display resolution and DejaVu's bytecode is most of
+        # the weight of each glyph.
+        options = ftsubset.Options(
+            notdef_outline=True,
+            recommended_glyphs=True,
+            glyph_names=True,
+            hinting=False,
+        )
+        options.drop_tables += DROP_TABLES
+        font = ttLib.TTFont(_MappedFile(self.data), recalcTimestamp=False, lazy=True)
+        subsetter = ftsubset.Subsetter(options)
+        subsetter.populate(glyphs=glyph_names)
+        subsetter.subset(font)
+        output = io.BytesIO()
+        font.save(output)
+        return output.getvalue()
+
+
+def _metrics_path(cache_dir, source):
+    return os.path.join(cache_dir, f"{source[0]}.fpdf-{fpdf.__version__}.metrics")
+
+
+def _load_metrics(cache_dir, source):
+    # One read and one unpickle instead of parsing the TTF tables. Stale
+    # or unreadable files are ignored and rewritten.
+    if not cache_dir:
+        return None
+    try:
+        with open(_metrics_path(cache_dir, source), "rb") as f:
+            key, proto = pickle.loads(f.read())
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+        return None
+    if key != (METRICS_VERSION, source):
+        return None
+    return proto
+
+
+def _save_metrics(cache_dir, source, proto):
+    if not cache_dir:
+        return
+    try:
+        with atomic_write(_metrics_path(cache_dir, source)) as f:
+            pickle.dump(((METRICS_VERSION, source), proto), f, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        # A read-only install still works, it just parses every time
+        pass
+
+
+class SubsetCache:
+    """Bounded LRU of encoded font subsets, keyed by face and glyph set."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, face, glyph_names):
+        key = (face, frozenset(glyph_names))
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = face.subset(sorted(key[1]))
+        with self._lock:
+            self._entries[key] = data
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class FontRegistry:
+    def __init__(self, family, faces, font_dir=FONT_DIR, cache_dir=FONT_CACHE_DIR):
+        self.family = family
+        self.faces = dict(faces)
+        self.font_dir = font_dir
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._loaded = {}
+        self._lock = threading.Lock()
+        self.subsets = SubsetCache()
+
+    def preload(self):
+        for style in self.faces:
+            self._face(style)
+        return self
+
+    def ready(self):
+        return len(self._loaded) == len(self.faces)
+
+    def _face(self, style):
+        face = self._loaded.get(style)
+        if face is not None:
+            with self._lock:
+                self.hits += 1
+            return face
+        with self._lock:
+            face = self._loaded.get(style)
+            if face is None:
+                path = os.path.join(self.font_dir, self.faces[style])
+                face = _Face(path, self.family, style, self.cache_dir)
+                self._loaded[style] = face
+                self.misses += 1
+            else:
+                self.hits += 1
+        return face
+
+    def install(self, pdf):
+        for style in self.faces:
+            fontkey = f"{self.family.lower()}{style}"
+            if fontkey not in pdf.fonts:
+                pdf.fonts[fontkey] = self._face(style).instantiate(pdf)
+
+    def apply_subsets(self, pdf):
+        # Swap each registry font's TTFont for an already-subset copy, so
+        # the subsetting fpdf runs while writing only walks a few dozen glyphs.
+        for style, face in self._loaded.items():
+            font = pdf.fonts.get(f"{self.family.lower()}{style}")
+            if font is None or font.ttffile != face.proto.ttffile:
+                continue
+            data = self.subsets.get(face, font.subset.get_all_glyph_names())
+            font.ttfont.close()
+            font.ttfont = ttLib.TTFont(io.BytesIO(data), recalcTimestamp=False, lazy=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "family": self.family,
+                "faces": len(self._loaded),
+                "hits": self.hits,
+                "misses": self.misses,
+                "subsets": self.subsets.stats(),
+                "text_widths": {style: face.widths.stats() for style, face in self._loaded.items()},
+            }
+
+
+class SubsetOutputProducer(OutputProducer):
+    # Runs after the last footer and the {nb} alias have picked their glyphs
+    def bufferize(self):
+        FONTS.apply_subsets(self.fpdf)
+        return super().bufferize()
+
+
+FONTS = FontRegistry("DejaVu", DEJAVU_FACES)
+
+
+if __name__ == "__main__":
+    # Prebuild the metrics cache, e.g. while building a container image
+    FONTS.preload()
+    print(f"Font metrics for {len(FONTS.faces)} faces cached in {FONTS.cache_dir}")
@@ -3,7 +3,10 @@ from fpdf import FPDF
 import io
 import datetime
 
+from font_registry import FONTS
+
 app = Flask(__name__)
+FONTS.preload()
 
 form_template = """
 <!DOCTYPE html>
@@ -98,9 +101,6 @@ def generate_invoice():
 def create_pdf(company_info, client_info, invoice_data, items):
     class InvoicePDF(FPDF):
         def header(self):
-            # Load Unicode fonts for euro symbol
-            self.add_font('DejaVu', '', 'DejaVuSans.ttf', uni=True)
-            self.add_font('DejaVu', 'B', 'DejaVuSans-Bold.ttf', uni=True)
             self.set_fill_color(0, 51, 102)  # Dark blue
             self.rect(0, 0, 210, 30, 'F')
             self.set_text_color(255, 255, 255)
@@ -115,6 +115,8 @@ def create_pdf(company_info, client_info, invoice_data, items):
             self.cell(0, 10, f"Page {self.page_no()}/{{nb}}", 0, 0, 'C')
 
     pdf = InvoicePDF()
+    # Unicode fonts for the euro symbol, parsed once per process
+    FONTS.install(pdf)
     pdf.alias_nb_pages()
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
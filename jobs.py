@@ -0,0 +1,172 @@
+import os
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from batch import read_invoices, write_zip
+from storage import ThreadConnections, process_alive
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    finished REAL,
+    owner INTEGER
+)
+"""
+
+UNFINISHED = ("queued", "running")
+
+EXTENSIONS = {"pdf": ".pdf", "zip": ".zip"}
+
+
+class JobQueue:
+    """Background render queue.
+
+    Jobs run on a small thread pool in the process that accepted them, but
+    their state lives in SQLite and their output in files next to it, so
+    any worker process on the host can answer a status poll or a download.
+
+    A job dies with the process that owns it. The pool's threads are
+    daemons, so an exiting worker is not held past its graceful timeout,
+    and the jobs it left unfinished are failed when polled or when a
+    queue opens the directory. Jobs are pruned ttl seconds after they
+    finish, and whatever their state, twice that after they were created.
+    """
+
+    def __init__(self, directory, workers=2, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        self.workers = workers
+        os.makedirs(directory, exist_ok=True)
+        self._db = ThreadConnections(os.path.join(directory, "jobs.sqlite3"), row_factory=sqlite3.Row)
+        self._queue = None
+        self._queue_pid = None
+        self._lock = threading.Lock()
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(SCHEMA)
+            if not any(row["name"] == "owner" for row in db.execute("PRAGMA table_info(jobs)")):
+                # Jobs from before owners were recorded belong to no running process
+                db.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")
+        self._fail_orphans()
+
+    def _pool(self):
+        with self._lock:
+            if self._queue is None or self._queue_pid != os.getpid():
+                self._queue = queue.SimpleQueue()
+                self._queue_pid = os.getpid()
+                for index in range(self.workers):
+                    threading.Thread(
+                        target=self._work, args=(self._queue,), name=f"render-job-{index}", daemon=True,
+                    ).start()
+            return self._queue
+
+    def _work(self, jobs):
+        while True:
+            self._run(*jobs.get())
+
+    def path(self, job_id, kind):
+        return os.path.join(self.directory, job_id + EXTENSIONS[kind])
+
+    def submit(self, kind, fn, *args):
+        """Queue fn(*args, output_path) and return the new job id at once."""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO jobs (id, kind, status, created, owner) VALUES (?, ?, 'queued', ?, ?)",
+                (job_id, kind, time.time(), os.getpid()),
+            )
+        self._pool().put((job_id, fn, args, self.path(job_id, kind)))
+        return job_id
+
+    def _run(self, job_id, fn, args, output_path):
+        self._set(job_id, "running")
+        try:
+            fn(*args, output_path)
+        except Exception as e:
+            self._set(job_id, "failed", f"{type(e).__name__}: {e}")
+        else:
+            self._set(job_id, "done")
+
+    def _set(self, job_id, status, error=None):
+        finished = time.time() if status in ("done", "failed") else None
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                (status, error, finished, job_id),
+            )
+
+    def _fail_orphans(self, job_id=None):
+        # Unfinished jobs of processes that are gone will never finish
+        sql = f"SELECT id, owner FROM jobs WHERE status IN ({', '.join('?' * len(UNFINISHED))})"
+        params = list(UNFINISHED)
+        if job_id is not None:
+            sql += " AND id = ?"
+            params.append(job_id)
+        for row in self._db().execute(sql, params).fetchall():
+            if row["owner"] is None or not process_alive(row["owner"]):
+                self._set(row["id"], "failed", "the worker process running it exited")
+
+    def get(self, job_id):
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is not None and row["status"] in UNFINISHED:
+            self._fail_orphans(job_id)
+            row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def ready(self):
+        return self._db.ready()
+
+    def counts(self):
+        rows = self._db().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        with self._db() as db:
+            expired = db.execute(
+                "SELECT id, kind FROM jobs WHERE (finished IS NOT NULL AND finished < ?) OR created < ?",
+                (cutoff, cutoff - self.ttl),
+            ).fetchall()
+            db.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in expired])
+        for row in expired:
+            try:
+                os.remove(self.path(row["id"], row["kind"]))
+            except OSError:
+                pass
+
+
+def render_invoice_file(render, invoice, output_path):
+    data = render(invoice)
+    with open(output_path, "wb") as f:
+        f.write(data)
+
+
+def render_batch_file(input_path, fmt, output_path, prepare=None):
+    # prepare: optional filter over the invoices read, e.g. numbering
+    try:
+        with open(input_path, encoding="utf-8", newline="") as lines:
+            invoices = read_invoices(lines, fmt)
+            if prepare is not None:
+                invoices = prepare(invoices)
+            with open(output_path, "wb") as f:
+                write_zip(invoices, f)
+    finally:
+        os.remove(input_path)
+
+
+def spool_upload(upload, directory):
+    # Uploads are closed when the request ends, long before the job runs
+    fd, input_path = tempfile.mkstemp(prefix="upload-", suffix=".in", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        shutil.copyfileobj(upload.stream, f)
+    return input_path
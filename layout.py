@@ -0,0 +1,208 @@
+import threading
+
+from fpdf import FPDF
+from fpdf.enums import PDFResourceType
+
+from font_registry import FONTS, SubsetOutputProducer
+from metrics import METRICS
+
+# Graphics state a chrome block may change; replays restore what it did change
+_STATE_ATTRS = (
+    "x", "y",
+    "draw_color", "fill_color", "text_color", "line_width",
+    "font_family", "font_style", "font_size_pt",
+    "current_font_is_set_on_page",
+)
+
+
+class PageChrome:
+    """Fixed page furniture recorded once as raw content-stream operators.
+
+    Text in a TrueType font is written as subset character ids, so a replay
+    is only valid when the document hands out the same ids for the same
+    glyphs. stamp() checks that and falls back to drawing when it doesn't.
+    """
+
+    def __init__(self, draw):
+        self.draw = draw
+        self.hits = 0
+        self.misses = 0
+        self._recording = None
+        self._lock = threading.Lock()
+
+    def preload(self):
+        with self._lock:
+            if self._recording is None:
+                pdf = FPDF()
+                FONTS.install(pdf)
+                pdf.add_page()
+                self._recording = self._record(pdf)
+        return self
+
+    def ready(self):
+        return self._recording is not None
+
+    def _record(self, pdf):
+        contents = pdf.pages[pdf.page].contents
+        start = len(contents)
+        picked = {key: len(font.subset) for key, font in pdf.fonts.items()}
+        before = {attr: getattr(pdf, attr) for attr in _STATE_ATTRS}
+        self.draw(pdf)
+        glyphs = []
+        for key, font in pdf.fonts.items():
+            used = list(font.subset.items())[picked.get(key, 0):]
+            if used:
+                glyphs.append((key, font.i, [(glyph.unicode[0], char_id) for glyph, char_id in used]))
+        state = {
+            attr: getattr(pdf, attr)
+            for attr in _STATE_ATTRS
+            if getattr(pdf, attr) != before[attr]
+        }
+        fontkey = pdf.current_font.fontkey if pdf.current_font else None
+        return bytes(contents[start:]), glyphs, state, fontkey
+
+    def _replayable(self, pdf, glyphs):
+        for key, index, picks in glyphs:
+            font = pdf.fonts.get(key)
+            if font is None or font.i != index or any(
+                font.subset.pick(uni) != char_id for uni, char_id in picks
+            ):
+                return False
+        return True
+
+    def stamp(self, pdf):
+        if self._recording is None:
+            self.preload()
+        ops, glyphs, state, fontkey = self._recording
+        if not self._replayable(pdf, glyphs):
+            self.misses += 1
+            self.draw(pdf)
+            return
+        pdf.pages[pdf.page].contents.extend(ops)
+        for _, index, _ in glyphs:
+            pdf._resource_catalog.add(PDFResourceType.FONT, index, pdf.page)
+        for attr, value in state.items():
+            setattr(pdf, attr, value)
+        pdf.current_font = pdf.fonts[fontkey] if fontkey else None
+        self.hits += 1
+
+    def stamp_form(self, pdf, writer):
+        """Like stamp(), but the recording is written once per document as
+        a form XObject (see pdf_stream) and each page only calls it."""
+        if self._recording is None:
+            self.preload()
+        ops, glyphs, state, fontkey = self._recording
+        if not self._replayable(pdf, glyphs):
+            self.misses += 1
+            self.draw(pdf)
+            return
+        pdf._out(f"/{writer.shared_form(self, ops)} Do")
+        # The form runs in a saved graphics state, so apart from the
+        # position the page is left as it was before it
+        for attr in ("x", "y"):
+            if attr in state:
+                setattr(pdf, attr, state[attr])
+        self.hits += 1
+
+
+def draw_header(pdf):
+    pdf.set_fill_color(0, 51, 102)  # Dark blue
+    pdf.rect(0, 0, 210, 30, 'F')
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font('DejaVu', 'B', 16)
+    pdf.cell(0, 20, "INVOICE", ln=True, align='C')
+    pdf.ln(10)
+    pdf.set_text_color(0, 0, 0)  # Reset text color
+
+
+HEADER = PageChrome(draw_header)
+
+# Item table columns as (width in mm, alignment), and the row height
+TABLE_COLUMNS = ((80, 'L'), (30, 'C'), (40, 'R'), (40, 'R'))
+ROW_HEIGHT = 8
+
+
+class InvoicePDF(FPDF):
+    # Set by pdf_stream.StreamingWriter while it owns the output
+    stream = None
+
+    def add_page(self, *args, **kwargs):
+        super().add_page(*args, **kwargs)
+        if self.stream is not None:
+            self.stream.flush_pages(self.page - 1)
+
+    def output(self, name="", **kwargs):
+        kwargs.setdefault("output_producer_class", SubsetOutputProducer)
+        return super().output(name, **kwargs)
+
+    def header(self):
+        with METRICS.stage("header"):
+            if self.stream is not None:
+                HEADER.stamp_form(self, self.stream)
+            else:
+                HEADER.stamp(self)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('DejaVu', '', 8)
+        if self.stream is not None:
+            self.stream.page_count_cell(f"Page {self.stream.page_number(self.page)}/", 10)
+        else:
+            self.cell(0, 10, f"Page {self.page_no()}/{{nb}}", 0, 0, 'C')
+
+    def table_header(self):
+        self.set_fill_color(200, 200, 200)
+        self.set_font("DejaVu", "B", 12)
+        self.cell(80, 8, "Description", border=1, align='C', fill=True)
+        self.cell(30, 8, "Qty", border=1, align='C', fill=True)
+        self.cell(40, 8, "Unit Price", border=1, align='C', fill=True)
+        self.cell(40, 8, "Amount", border=1, align='C', fill=True)
+        self.ln(8)
+
+    def item_rows(self, rows):
+        """Draw bordered table rows of (description, qty, unit price, amount).
+
+        Produces the same operators as one bordered cell() per column, but
+        the column geometry is worked out once per table and each row is
+        written in one go. When a row would cross the page break, a new page
+        is started and the table header repeated on it.
+        """
+        k = self.k
+        h_pt = ROW_HEIGHT * k
+        c_margin = self.c_margin * k
+        columns = []
+        x = self.l_margin
+        for width, align in TABLE_COLUMNS:
+            columns.append((x * k, width * k, align))
+            x += width
+
+        self.set_font("DejaVu", "", 12)
+        font = self.current_font
+        size = self.font_size_pt
+        baseline = 0.5 * h_pt + 0.3 * size
+        color = self.text_color.serialize().lower()
+        for row in rows:
+            if self.y + ROW_HEIGHT > self.page_break_trigger and self.accept_page_break:
+                self.add_page(same=True)
+                self.table_header()
+                self.set_font("DejaVu", "", 12)
+            if not self.current_font_is_set_on_page:
+                self._out(self._set_font_for_page(font, size))
+            top = (self.h - self.y) * k
+            ops = []
+            for (left, width, align), text in zip(columns, row):
+                if align == 'L':
+                    text_x = left + c_margin
+                else:
+                    text_width = font.get_text_width(text, size, None)[1]
+                    if align == 'R':
+                        text_x = left + width - c_margin - text_width
+                    else:
+                        text_x = left + (width - text_width) / 2
+                ops.append(
+                    f"q {left:.2f} {top:.2f} {width:.2f} {-h_pt:.2f} re S "
+                    f"BT {text_x:.2f} {top - baseline:.2f} Td {color} {font.encode_text(text)} ET Q"
+                )
+            self._out("\n".join(ops))
+            self.y += ROW_HEIGHT
+        self.x = self.l_margin
@@ -0,0 +1,103 @@
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+FORM = {
+    "company_name": "Nadine's Company",
+    "company_address": "123 Example Street",
+    "company_phone": "+33 1 23 45 67 89",
+    "company_email": "contact@nadine-company.com",
+    "company_nif": "XYZ123456789",
+    "client_name": "Nadine Imoma",
+    "client_address": "Av. Sierra Calderona 29A",
+    "client_nif": "Y9912567H",
+    "invoice_number": "2025/05",
+    "invoice_date": "01/05/2025",
+    "payment_method": "Bank Transfer",
+    "item_description": "Electrical Installation",
+    "item_qty": "1",
+    "item_price": "465.00",
+}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _client(url, deadline, unique, latencies, errors, lock, worker):
+    parts = urllib.parse.urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    sent = 0
+    while time.perf_counter() < deadline:
+        form = dict(FORM)
+        if unique:
+            # Defeat the render cache so every request renders a PDF
+            form["invoice_number"] = f"LT/{worker}/{sent}"
+        body = urllib.parse.urlencode(form)
+        start = time.perf_counter()
+        try:
+            conn.request("POST", parts.path or "/generate-invoice", body, headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+        elapsed = time.perf_counter() - start
+        sent += 1
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors.append(elapsed)
+
+
+def run(url, concurrency, duration, unique=True):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=_client, args=(url, deadline, unique, latencies, errors, lock, n))
+        for n in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "url": url,
+        "concurrency": concurrency,
+        "duration_s": round(wall, 2),
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / wall, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Closed-loop load test for /generate-invoice.")
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:8000/generate-invoice")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=30)
+    parser.add_argument("--cached", action="store_true",
+                        help="send the same invoice every time, so the render cache answers")
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.url, args.concurrency, args.duration, unique=not args.cached), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""In-process metrics with Prometheus text exposition.
+
+Counters and histograms live in plain dicts under one lock, so recording
+costs a couple of microseconds. Under gunicorn every worker process has
+its own numbers. With a directory configured, each process saves a
+snapshot there at most once per save_interval, and collect() adds up all
+the snapshots. When a process exits, retire() folds its counters and
+histograms into one file for exited processes and drops its gauges,
+which describe caches that are gone. This is the same idea as
+prometheus_client's multiprocess mode.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from storage import atomic_write, process_alive
+
+RETIRED = "retired.json"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPTIONS = {
+    "invoice_stage_seconds": ("histogram", "Time spent in each stage of a request or render"),
+    "invoice_pages_total": ("counter", "PDF pages rendered"),
+    "invoice_bytes_total": ("counter", "PDF bytes produced"),
+    "invoice_renders_total": ("counter", "Invoices rendered, by output mode"),
+    "http_requests_total": ("counter", "HTTP requests handled, by endpoint and status"),
+    "http_request_seconds": ("histogram", "HTTP request latency, by endpoint"),
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _merge(into, snapshot):
+    for kind in ("counters", "histograms"):
+        merged = {(name, tuple(map(tuple, labels))): value for name, labels, value in into.get(kind, ())}
+        for name, labels, value in snapshot.get(kind, ()):
+            key = (name, tuple(map(tuple, labels)))
+            if kind == "counters":
+                merged[key] = merged.get(key, 0) + value
+            else:
+                total = merged.setdefault(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(total, value)]
+        into[kind] = [[name, list(labels), value] for (name, labels), value in merged.items()]
+    return into
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self, directory=None, save_interval=1.0):
+        self.directory = directory
+        self.save_interval = save_interval
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._saved = 0.0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels_key(labels))
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            # Per-bucket counts, then sum and count
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 3)
+            histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def gauge(self, name, help_text, read):
+        """Register read() -> {labels tuple: value}, called for every
+        snapshot. Values from all processes are summed, so use it for
+        per-process quantities such as cache sizes and hit counts."""
+        self._gauges[name] = (help_text, read)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the with-block as invoice_stage_seconds{stage=name}.
+        Stages may nest, in which case their times overlap."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("invoice_stage_seconds", time.perf_counter() - start, stage=name)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        gauges = [
+            [name, list(labels), value]
+            for name, (_, read) in self._gauges.items()
+            for labels, value in read().items()
+        ]
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, list(labels), list(values)] for (name, labels), values in self._histograms.items()],
+                "gauges": gauges,
+            }
+
+    def save(self, force=False):
+        """Write this process's snapshot for collect() in other processes."""
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved < self.save_interval:
+            return
+        self._saved = now
+        self._write(f"{os.getpid()}.json", self.snapshot())
+
+    def _write(self, name, snapshot):
+        with atomic_write(os.path.join(self.directory, name), "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def retire(self, pid):
+        """Fold an exited process's snapshot into the retired one. Run
+        from a single process (the gunicorn master), which owns that file."""
+        if not self.directory:
+            return
+        snapshot = self._read(f"{pid}.json")
+        if snapshot is None:
+            return
+        self._write(RETIRED, _merge(self._read(RETIRED) or {}, snapshot))
+        os.unlink(os.path.join(self.directory, f"{pid}.json"))
+
+    def clear(self):
+        """Remove every saved snapshot: those of a previous run included."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith((".json", ".tmp")):
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def collect(self):
+        """Counters and histograms of every process, summed."""
+        snapshots = [self.snapshot()]
+        if self.directory and os.path.isdir(self.directory):
+            own = f"{os.getpid()}.json"
+            for name in os.listdir(self.directory):
+                if not name.endswith(".json") or name == own:
+                    continue
+                snapshot = self._read(name)
+                if snapshot is None:
+                    continue
+                pid = name[:-len(".json")]
+                if pid.isdigit() and not process_alive(int(pid)):
+                    # Not retired, e.g. under a plain gunicorn: its gauges are stale
+                    snapshot["gauges"] = []
+                snapshots.append(snapshot)
+        counters = {}
+        histograms = {}
+        gauges = {}
+        for snapshot in snapshots:
+            for kind, merged in (("counters", counters), ("gauges", gauges)):
+                for name, labels, value in snapshot.get(kind, ()):
+                    key = (name, tuple(map(tuple, labels)))
+                    merged[key] = merged.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+        return counters, histograms, gauges
+
+    def render(self, extra=()):
+        """Prometheus text format. extra: (name, help, {labels tuple: value})
+        gauges read once at scrape time, for values that are already global."""
+        counters, histograms, gauges = self.collect()
+        lines = []
+        names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+        for name in names:
+            kind, help_text = DESCRIPTIONS.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), values):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+        registered = [
+            (name, help_text, {labels: value for (metric, labels), value in gauges.items() if metric == name})
+            for name, (help_text, _) in sorted(self._gauges.items())
+        ]
+        for name, help_text, samples in registered + list(extra):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(samples.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
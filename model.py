@@ -0,0 +1,163 @@
+"""Typed invoice model.
+
+Parties and the invoice header are slotted dataclasses, so a misspelt
+field is an error instead of a silently blank cell. Line items are stored
+column-wise: quantities, prices and VAT rates in float arrays and
+descriptions as interned strings, which keeps a batch of tens of thousands
+of invoices small and hands the money engine its columns without copying.
+"""
+import datetime
+import math
+import sys
+from array import array
+from dataclasses import asdict, dataclass, field
+
+# Largest qty * price of a line. Totals are Decimals of at most 28 digits,
+# so this leaves room for millions of such lines and their VAT.
+MAX_AMOUNT = 10 ** 15
+
+
+class InvalidInvoice(ValueError):
+    pass
+
+
+def _check_strings(obj):
+    for name in obj.__slots__:
+        if not isinstance(getattr(obj, name), str):
+            raise InvalidInvoice(f"{type(obj).__name__}.{name} must be a string")
+
+
+@dataclass(slots=True)
+class Company:
+    name: str = ""
+    address: str = ""
+    phone: str = ""
+    email: str = ""
+    nif: str = ""
+
+    def __post_init__(self):
+        _check_strings(self)
+
+
+@dataclass(slots=True)
+class Client:
+    name: str = ""
+    address: str = ""
+    nif: str = ""
+
+    def __post_init__(self):
+        _check_strings(self)
+
+
+@dataclass(slots=True)
+class InvoiceHeader:
+    invoice_number: str = ""
+    invoice_date: str = ""
+    payment_method: str = ""
+    additional_info: str = ""
+    # Keys into tax.TAX; blank for the default region and its currency
+    tax_region: str = ""
+    currency: str = ""
+
+    def __post_init__(self):
+        _check_strings(self)
+
+    def date(self):
+        """invoice_date, typed DD/MM/YYYY, as a datetime.date; None when it
+        is blank or not a date."""
+        try:
+            return datetime.datetime.strptime(self.invoice_date, "%d/%m/%Y").date()
+        except ValueError:
+            return None
+
+
+class Items:
+    """Line items as parallel columns.
+
+    A NaN in vat_rate means the line uses the invoice's default rate.
+    Iterating yields one dict per line, in the shape the readers accept.
+    """
+
+    __slots__ = ("descriptions", "qty", "price", "vat_rate")
+
+    def __init__(self):
+        self.descriptions = []
+        self.qty = array("d")
+        self.price = array("d")
+        self.vat_rate = array("d")
+
+    @classmethod
+    def from_dicts(cls, items):
+        columns = cls()
+        for item in items:
+            columns.append(**item)
+        return columns
+
+    def append(self, description, qty, price, vat_rate=None):
+        if not isinstance(description, str):
+            raise InvalidInvoice("item description must be a string")
+        qty = float(qty)
+        price = float(price)
+        if not (math.isfinite(qty) and math.isfinite(price)):
+            raise InvalidInvoice(f"item {description!r}: qty and price must be finite numbers")
+        if abs(qty * price) > MAX_AMOUNT:
+            raise InvalidInvoice(f"item {description!r}: qty * price must be at most {MAX_AMOUNT:,}")
+        if vat_rate is None:
+            vat_rate = math.nan
+        else:
+            vat_rate = float(vat_rate)
+            if not 0 <= vat_rate <= 1:
+                raise InvalidInvoice(f"item {description!r}: vat_rate must be a fraction between 0 and 1")
+        self.descriptions.append(sys.intern(description))
+        self.qty.append(qty)
+        self.price.append(price)
+        self.vat_rate.append(vat_rate)
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def __iter__(self):
+        for description, qty, price, vat_rate in zip(self.descriptions, self.qty, self.price, self.vat_rate):
+            item = {"description": description, "qty": qty, "price": price}
+            if not math.isnan(vat_rate):
+                item["vat_rate"] = vat_rate
+            yield item
+
+    def __eq__(self, other):
+        if not isinstance(other, Items):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"Items({list(self)!r})"
+
+
+@dataclass(slots=True)
+class Invoice:
+    company: Company = field(default_factory=Company)
+    client: Client = field(default_factory=Client)
+    header: InvoiceHeader = field(default_factory=InvoiceHeader)
+    items: Items = field(default_factory=Items)
+
+    @classmethod
+    def from_dicts(cls, company_info, client_info, invoice_data, items):
+        """Build from the loose dicts invoices used to be passed around as.
+        Unknown keys raise InvalidInvoice."""
+        try:
+            return cls(
+                Company(**company_info),
+                Client(**client_info),
+                InvoiceHeader(**invoice_data),
+                Items.from_dicts(items),
+            )
+        except TypeError as e:
+            raise InvalidInvoice(str(e)) from None
+
+    def as_record(self):
+        # Same shape as a batch JSONL record
+        return {
+            "company": asdict(self.company),
+            "client": asdict(self.client),
+            "invoice": asdict(self.header),
+            "items": list(self.items),
+        }
@@ -0,0 +1,133 @@
+"""Exact invoice arithmetic.
+
+Amounts are Decimals. The rounding policy is explicit: every line total is
+rounded to the cent, VAT is computed once per rate on the sum of that
+rate's rounded lines and rounded to the cent, and the total is the
+subtotal plus those VAT amounts, so the printed figures always add up.
+"""
+import math
+from decimal import ROUND_HALF_EVEN, ROUND_HALF_UP, Decimal
+
+from model import Items
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CENT = Decimal("0.01")
+DEFAULT_VAT_RATE = Decimal("0.21")
+ROUNDING = ROUND_HALF_UP
+# Below this many lines converting to arrays costs more than it saves
+NUMPY_MIN_ITEMS = 5000
+# Fixed-point scales for the array path: quantities in thousandths, prices in cents
+QTY_SCALE = 1000
+PRICE_SCALE = 100
+
+
+def to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        # repr is the shortest string that round-trips, i.e. what was typed
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+def cents(amount, rounding=ROUNDING):
+    return amount.quantize(CENT, rounding=rounding)
+
+
+def format_rate(rate):
+    return f"{(to_decimal(rate) * 100).normalize():f}%"
+
+
+def compute_totals(items, default_rate=DEFAULT_VAT_RATE, rounding=ROUNDING, use_numpy=None):
+    """Line totals, subtotal and VAT per rate for an Items column store
+    (or a list of item dicts).
+
+    Lines may carry their own VAT rate; the rest use default_rate.
+    use_numpy=None picks the array path for large invoices when NumPy is
+    installed and every amount fits its fixed-point range.
+    """
+    if not isinstance(items, Items):
+        items = Items.from_dicts(items)
+    default_rate = to_decimal(default_rate)
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(items) >= NUMPY_MIN_ITEMS
+    lines = net = None
+    if use_numpy:
+        lines, net = _array_lines(items, default_rate, rounding)
+    if lines is None:
+        lines, net = _decimal_lines(items, default_rate, rounding)
+
+    if not net:
+        net = {default_rate: Decimal("0.00")}
+    vat = {rate: cents(amount * rate, rounding) for rate, amount in sorted(net.items())}
+    subtotal = sum(net.values(), Decimal("0.00"))
+    vat_total = sum(vat.values(), Decimal("0.00"))
+    return {
+        "lines": lines,
+        "subtotal": subtotal,
+        "vat": vat,
+        "vat_total": vat_total,
+        "total": subtotal + vat_total,
+    }
+
+
+def _decimal_lines(items, default_rate, rounding):
+    lines = []
+    net = {}
+    for qty, price, rate in zip(items.qty, items.price, items.vat_rate):
+        line = cents(to_decimal(qty) * to_decimal(price), rounding)
+        rate = default_rate if math.isnan(rate) else to_decimal(rate)
+        net[rate] = net.get(rate, Decimal("0.00")) + line
+        lines.append(line)
+    return lines, net
+
+
+def _fixed(column, scale):
+    # int64 array of column * scale, or None unless the scale holds every
+    # value exactly (at most log10(scale) decimals)
+    values = numpy.frombuffer(column, dtype=numpy.float64)
+    scaled = numpy.rint(values * scale)
+    if not (numpy.all(scaled / scale == values) and numpy.all(numpy.abs(scaled) < 2 ** 53)):
+        return None
+    return scaled.astype(numpy.int64)
+
+
+def _array_lines(items, default_rate, rounding):
+    """Same as _decimal_lines on int64 arrays, or (None, None) when an amount
+    does not fit the fixed-point scales or the rounding mode is unsupported."""
+    if not len(items) or rounding not in (ROUND_HALF_UP, ROUND_HALF_EVEN):
+        return None, None
+    qtys = _fixed(items.qty, QTY_SCALE)
+    prices = _fixed(items.price, PRICE_SCALE)
+    if qtys is None or prices is None:
+        return None, None
+    # Every product and the per-rate sums must stay inside int64
+    if int(numpy.abs(qtys).max()) * int(numpy.abs(prices).max()) * len(items) >= 2 ** 62:
+        return None, None
+
+    products = qtys * prices
+    whole, rest = numpy.divmod(numpy.abs(products), QTY_SCALE)
+    half = QTY_SCALE // 2
+    if rounding == ROUND_HALF_UP:
+        up = rest >= half
+    else:
+        up = (rest > half) | ((rest == half) & (whole % 2 == 1))
+    line_cents = numpy.sign(products) * (whole + up)
+
+    # Rates are validated to lie in [0, 1], so -1 stands for "the default"
+    rates = numpy.frombuffer(items.vat_rate, dtype=numpy.float64)
+    rates = numpy.where(numpy.isnan(rates), -1.0, rates)
+    unique_rates, index = numpy.unique(rates, return_inverse=True)
+    sums = numpy.zeros(len(unique_rates), dtype=numpy.int64)
+    numpy.add.at(sums, index, line_cents)
+
+    net = {}
+    for rate, total in zip(unique_rates.tolist(), sums.tolist()):
+        rate = default_rate if rate == -1 else to_decimal(rate)
+        net[rate] = net.get(rate, Decimal("0.00")) + Decimal(total).scaleb(-2)
+    lines = [Decimal(value).scaleb(-2) for value in line_cents.tolist()]
+    return lines, net
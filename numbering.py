@@ -0,0 +1,205 @@
+import datetime
+import os
+import threading
+import time
+
+from storage import ThreadConnections
+from tax import TAX
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (
+    series TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    next INTEGER NOT NULL,
+    PRIMARY KEY (series, year)
+);
+CREATE TABLE IF NOT EXISTS returned (
+    series TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    PRIMARY KEY (series, year, number)
+);
+CREATE TABLE IF NOT EXISTS issued (
+    series TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    invoice_number TEXT NOT NULL,
+    issued REAL NOT NULL,
+    client_nif TEXT NOT NULL,
+    subtotal TEXT NOT NULL,
+    vat_total TEXT NOT NULL,
+    total TEXT NOT NULL,
+    PRIMARY KEY (series, year, number)
+);
+"""
+
+NUMBER_FORMAT = "{series}{year}/{number:05d}"
+
+
+class Ledger:
+    """Sequential invoice numbers per series and year, and a record of
+    what was issued under each.
+
+    Processes take numbers from the shared counter in blocks, so issuing
+    one only takes a lock inside the process. Numbers a process did not use
+    go back to the ledger on close() and are handed out before new ones,
+    which keeps the sequence free of gaps. A process that dies without
+    closing leaves its unused block unissued; unissued() lists them. Each
+    issue is written to the issued table, in batches of flush_every.
+    """
+
+    def __init__(self, path, block_size=16, flush_every=1, number_format=NUMBER_FORMAT):
+        self.path = path
+        self.block_size = block_size
+        self.flush_every = flush_every
+        self.number_format = number_format
+        self._db = ThreadConnections(path, setup=["PRAGMA synchronous=NORMAL"], isolation_level=None)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._blocks = {}
+        self._pending = []
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    def _forked(self):
+        # A forked child must not issue from the blocks its parent holds
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._blocks = {}
+            self._pending = []
+
+    def _reserve(self, series, year):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            numbers = [
+                number for (number,) in db.execute(
+                    "SELECT number FROM returned WHERE series = ? AND year = ? ORDER BY number LIMIT ?",
+                    (series, year, self.block_size),
+                )
+            ]
+            if numbers:
+                db.execute(
+                    f"DELETE FROM returned WHERE series = ? AND year = ? AND number IN ({','.join('?' * len(numbers))})",
+                    (series, year, *numbers),
+                )
+            else:
+                row = db.execute(
+                    "SELECT next FROM counters WHERE series = ? AND year = ?", (series, year)
+                ).fetchone()
+                start = row[0] if row else 1
+                db.execute(
+                    "INSERT OR REPLACE INTO counters (series, year, next) VALUES (?, ?, ?)",
+                    (series, year, start + self.block_size),
+                )
+                numbers = list(range(start, start + self.block_size))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        # Popped from the end, so reversed to issue in ascending order
+        numbers.reverse()
+        return numbers
+
+    def next_number(self, series="", year=None):
+        year = year or datetime.date.today().year
+        with self._lock:
+            self._forked()
+            block = self._blocks.get((series, year))
+            if not block:
+                block = self._blocks[(series, year)] = self._reserve(series, year)
+            return block.pop()
+
+    def format(self, series, year, number):
+        return self.number_format.format(series=series, year=year, number=number)
+
+    def issue(self, invoice, series="", year=None, totals=None):
+        """Give invoice the next number of its series and year (the year of
+        its date unless given), record it and return the number string."""
+        if not year:
+            # An undated invoice numbers in the current year
+            date = invoice.header.date() or datetime.date.today()
+            year = date.year
+        # Before taking a number: an invoice that cannot be totalled must
+        # not use one up
+        totals = totals or TAX.totals(invoice)
+        number = self.next_number(series, year)
+        invoice_number = self.format(series, year, number)
+        invoice.header.invoice_number = invoice_number
+        record = (
+            series, year, number, invoice_number, time.time(), invoice.client.nif,
+            str(totals["subtotal"]), str(totals["vat_total"]), str(totals["total"]),
+        )
+        with self._lock:
+            self._pending.append(record)
+            if len(self._pending) >= self.flush_every:
+                self._flush()
+        return invoice_number
+
+    def _flush(self):
+        if not self._pending:
+            return
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("INSERT INTO issued VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._pending)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._forked()
+            self._flush()
+
+    def close(self):
+        """Write pending records and hand unused numbers back."""
+        with self._lock:
+            self._forked()
+            self._flush()
+            blocks, self._blocks = self._blocks, {}
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for (series, year), numbers in blocks.items():
+                    if not numbers:
+                        continue
+                    # The unused tail of the latest block: wind the counter back
+                    wound = max(numbers) - min(numbers) + 1 == len(numbers) and db.execute(
+                        "UPDATE counters SET next = ? WHERE series = ? AND year = ? AND next = ?",
+                        (min(numbers), series, year, max(numbers) + 1),
+                    ).rowcount
+                    if not wound:
+                        db.executemany(
+                            "INSERT INTO returned (series, year, number) VALUES (?, ?, ?)",
+                            [(series, year, number) for number in numbers],
+                        )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def ready(self):
+        return self._db.ready()
+
+    def unissued(self, series="", year=None):
+        """Numbers below the counter that were neither issued nor returned:
+        held by running processes, or lost with one that died."""
+        year = year or datetime.date.today().year
+        db = self._db()
+        row = db.execute("SELECT next FROM counters WHERE series = ? AND year = ?", (series, year)).fetchone()
+        if row is None:
+            return []
+        taken = {
+            number for (number,) in db.execute(
+                "SELECT number FROM issued WHERE series = ? AND year = ? "
+                "UNION SELECT number FROM returned WHERE series = ? AND year = ?",
+                (series, year, series, year),
+            )
+        }
+        return [number for number in range(1, row[0]) if number not in taken]
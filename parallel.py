@@ -0,0 +1,43 @@
+import collections
+import os
+
+from font_registry import FONTS
+from layout import HEADER
+from render import create_pdf
+
+
+def _init_worker():
+    # Parse fonts and record the page chrome once per worker process
+    FONTS.preload()
+    HEADER.preload()
+
+
+def render_one(invoice):
+    # Readers hand over unparseable rows as exceptions, in input order
+    if isinstance(invoice, Exception):
+        return None, str(invoice)
+    try:
+        return create_pdf(invoice).getvalue(), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def render_parallel(invoices, workers=None, max_pending=None):
+    """Render invoices across a process pool, yielding (data, error) in input order.
+
+    At most max_pending invoices are in flight at once, so a slow consumer
+    or a huge input never piles rendered PDFs up in memory. An invoice that
+    fails to render yields (None, message) without stopping the batch.
+    """
+    # Pulls in multiprocessing, which single-process runs never need
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        for invoice in invoices:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(pool.submit(render_one, invoice))
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,109 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+from dataclasses import asdict
+
+from storage import atomic_write
+from tax import TAX
+
+# Bump when the rendered layout changes, so stale on-disk entries stop matching
+LAYOUT_VERSION = 3
+
+
+def invoice_key(invoice):
+    normalized = {
+        "layout": LAYOUT_VERSION,
+        "tax": TAX.fingerprint,
+        "company": asdict(invoice.company),
+        "client": asdict(invoice.client),
+        "invoice": asdict(invoice.header),
+        "items": [
+            {
+                "description": item["description"],
+                "qty": item["qty"],
+                "price": item["price"],
+                "vat_rate": item.get("vat_rate"),
+            }
+            for item in invoice.items
+        ],
+    }
+    encoded = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    """Rendered PDFs by content key: an in-memory LRU under a byte budget,
+    backed by an optional directory that survives restarts."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pdf")
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.directory:
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self._remember(key, data)
+                with self._lock:
+                    self.hits += 1
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.directory:
+            with atomic_write(self._path(key)) as f:
+                f.write(data)
+
+    def _remember(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def render(self, render, invoice):
+        """Return (key, pdf bytes), calling render only on a cache miss."""
+        key = invoice_key(invoice)
+        data = self.get(key)
+        if data is None:
+            data = render(invoice).getvalue()
+            self.put(key, data)
+        return key, data
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,432 @@
+"""Incremental PDF output.
+
+StreamingWriter writes each page's content stream and page object as soon
+as the page is finished and then drops that page's buffer, so a long
+invoice never holds more than the page being drawn. What is only known at
+the end goes out when the document is closed:
+- the font subsets
+- the shared resources dictionary
+- the page count
+- the page tree, catalog and cross-reference table
+
+PDF objects may appear in any order as long as the cross-reference table
+points at them.
+
+The total page count ("Page 3/12") is drawn through a form XObject written
+at the end, since the pages showing it have long been sent by then.
+
+Several invoices can share one document as sections. Each section gets its
+own page numbering, count XObject, page label and bookmark. Anything drawn
+the same way on every page can go into a shared form XObject and is then
+written only once.
+
+For smaller files, streams can be deflated at any zlib level. With
+object_streams, the dictionaries are packed into compressed object streams
+and the cross-reference table becomes a compressed stream as well (PDF
+1.5). Objects are numbered and written in the order they are drawn, so the
+same document always comes out as the same bytes.
+"""
+import bisect
+import hashlib
+import queue
+import struct
+import threading
+import zlib
+
+from fpdf.output import OutputProducer, PDFHeader
+from fpdf.syntax import PDFContentStream, PDFString, create_dictionary_string
+from fpdf.syntax import iobj_ref as pdf_ref
+
+from font_registry import FONTS
+
+PAGE_COUNT_XOBJECT = "TP"
+SHARED_FORM_XOBJECT = "SF"
+# Width reserved for the page count, as fpdf does for "{nb}"
+PAGE_COUNT_PLACEHOLDER = "000"
+# Objects per object stream. Each stream is deflated on its own, so larger
+# ones compress better but wait longer in memory before they are written.
+OBJECT_STREAM_SIZE = 100
+
+
+class _Stream(PDFContentStream):
+    # fpdf's content stream, deflated at a chosen zlib level
+    def __init__(self, contents, compress, level=-1):
+        self._COMPRESSION_LEVEL = level
+        super().__init__(contents=contents, compress=compress)
+
+
+class StreamingWriter:
+    """compress_level: zlib level 0-9 for every stream, fonts included;
+    None keeps fpdf's default. object_streams: pack objects into object
+    streams and write a cross-reference stream."""
+
+    def __init__(self, pdf, write, compress_level=None, object_streams=False):
+        self.pdf = pdf
+        self.write = write
+        self.compress_level = compress_level
+        self.object_streams = object_streams
+        # (object id, body) waiting for the next object stream, and where
+        # the ones already written went: object id -> (stream id, index)
+        self._packed = []
+        self.packed_at = {}
+        self.position = 0
+        self.offsets = {}
+        self.page_ids = []
+        self.page_count_font = None
+        self.forms = {}
+        self._hash = hashlib.md5(usedforsecurity=False)
+        self.obj_id = pdf._resource_catalog.last_reserved_object_id
+        # Referenced by every page, written last
+        self.pages_root_id = self._reserve()
+        self.resources_id = self._reserve()
+        # (first page, page count XObject id, title); the whole document
+        # is one untitled section unless start_section() says otherwise
+        self.sections = [(1, self._reserve(), None)]
+        self._section_starts = [1]
+        pdf.stream = self
+        if object_streams:
+            pdf._set_min_pdf_version("1.5")
+        self._out(PDFHeader(pdf.pdf_version).serialize())
+
+    def _reserve(self):
+        self.obj_id += 1
+        return self.obj_id
+
+    def _out(self, data):
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        data += b"\n"
+        self._hash.update(data)
+        self.write(data)
+        self.position += len(data)
+
+    @property
+    def _level(self):
+        return -1 if self.compress_level is None else self.compress_level
+
+    def _stream(self, contents):
+        return _Stream(contents, self.pdf.compress, self._level)
+
+    def _emit(self, obj):
+        if obj.content_stream() is None:
+            if self.object_streams:
+                # serialize() wraps the dictionary in "<id> 0 obj ... endobj"
+                body = obj.serialize()
+                self._pack(obj.id, body[body.index("\n") + 1:-len("\nendobj")])
+                return
+        elif self.compress_level is not None and getattr(obj, "filter", None) == "FlateDecode":
+            # Font programs and maps from fpdf, deflated at its default level
+            obj._contents = zlib.compress(zlib.decompress(obj._contents), self.compress_level)
+            obj.length = len(obj._contents)
+        self.offsets[obj.id] = self.position
+        self._out(obj.serialize())
+
+    def _object(self, obj_id, entries):
+        body = create_dictionary_string(dict(sorted(entries.items())))
+        if self.object_streams:
+            self._pack(obj_id, body)
+            return
+        self.offsets[obj_id] = self.position
+        self._out(f"{obj_id} 0 obj\n{body}\nendobj")
+
+    def _stream_object(self, obj_id, entries, data):
+        stream = _Stream(data, self.pdf.compress, self._level)
+        stream.id = obj_id
+        entries["/Length"] = stream.length
+        if stream.filter:
+            entries["/Filter"] = "/FlateDecode"
+        self.offsets[obj_id] = self.position
+        self._out(stream.serialize(obj_dict=dict(sorted(entries.items()))))
+
+    def _pack(self, obj_id, body):
+        self._packed.append((obj_id, body))
+        if len(self._packed) >= OBJECT_STREAM_SIZE:
+            self._write_object_stream()
+
+    def _write_object_stream(self):
+        if not self._packed:
+            return
+        stream_id = self._reserve()
+        offsets = []
+        position = 0
+        for index, (obj_id, body) in enumerate(self._packed):
+            offsets.append(f"{obj_id} {position}")
+            position += len(body) + 1
+            self.packed_at[obj_id] = (stream_id, index)
+        header = " ".join(offsets) + "\n"
+        data = header + "\n".join(body for _, body in self._packed) + "\n"
+        self._stream_object(stream_id, {
+            "/Type": "/ObjStm", "/N": len(self._packed), "/First": len(header),
+        }, data.encode("latin-1"))
+        self._packed = []
+
+    def flush_pages(self, last):
+        """Write pages up to and including number last, then free their content."""
+        for number in range(len(self.page_ids) + 1, last + 1):
+            page = self.pdf.pages[number]
+            contents = self._stream(page.contents)
+            contents.id = self._reserve()
+            self._emit(contents)
+            page_id = self._reserve()
+            self._object(page_id, {
+                "/Type": "/Page",
+                "/Parent": pdf_ref(self.pages_root_id),
+                "/Resources": pdf_ref(self.resources_id),
+                "/Contents": pdf_ref(contents.id),
+            })
+            self.page_ids.append(page_id)
+            page.contents = bytearray()
+
+    def _form(self, obj_id, contents, placed=False):
+        # Forms clip to their box: the page, or for one moved with cm to
+        # the baseline of its text, the page around that point, which
+        # leaves room for glyphs that dip below the baseline
+        form = self._stream(contents)
+        form.id = obj_id
+        form.type = "/XObject"
+        form.subtype = "/Form"
+        w, h = self.pdf.w * self.pdf.k, self.pdf.h * self.pdf.k
+        form.b_box = f"[{-w:.2f} {-h:.2f} {w:.2f} {h:.2f}]" if placed else f"[0 0 {w:.2f} {h:.2f}]"
+        form.resources = pdf_ref(self.resources_id)
+        self._emit(form)
+
+    def shared_form(self, key, contents):
+        """Name of a form XObject drawing contents, written the first time
+        key asks for it."""
+        entry = self.forms.get(key)
+        if entry is None:
+            entry = self.forms[key] = (f"{SHARED_FORM_XOBJECT}{len(self.forms) + 1}", self._reserve())
+            self._form(entry[1], contents)
+        return entry[0]
+
+    def start_section(self, title=None):
+        """Start the next page in a new section: its pages are numbered
+        from 1 and counted on their own, and a title adds a bookmark and a
+        page label for it."""
+        first = self.pdf.page + 1
+        if self._section_starts[-1] == first:
+            # Nothing drawn in the current one yet, so it becomes the new one
+            self.sections[-1] = (first, self.sections[-1][1], title)
+            return
+        self.sections.append((first, self._reserve(), title))
+        self._section_starts.append(first)
+
+    def _section_index(self, page):
+        return bisect.bisect_right(self._section_starts, page) - 1
+
+    def page_number(self, page):
+        """Number of page within its section."""
+        return page - self._section_starts[self._section_index(page)] + 1
+
+    def page_count_cell(self, prefix, h):
+        """Stand-in for cell(0, h, prefix + "{nb}", align="C"): draws prefix
+        and leaves room for the page count of the page's section, which an
+        XObject fills in."""
+        pdf = self.pdf
+        k = pdf.k
+        font = pdf.current_font
+        size = pdf.font_size_pt
+        if not pdf.current_font_is_set_on_page:
+            pdf._out(pdf._set_font_for_page(font, size))
+        prefix_width = font.get_text_width(prefix, size, None)[1]
+        reserved = font.get_text_width(PAGE_COUNT_PLACEHOLDER, size, None)[1]
+        width = (pdf.w - pdf.r_margin - pdf.x) * k
+        # Rounded as Td writes it: the count goes where the text of the
+        # buffered cell ends, the written start plus the prefix's advance
+        x = round(pdf.x * k + (width - prefix_width - reserved) / 2, 2)
+        y = (pdf.h - pdf.y - 0.5 * h - 0.3 * pdf.font_size) * k
+        color = pdf.text_color.serialize().lower()
+        pdf._out(
+            f"q BT {x:.2f} {y:.2f} Td {color} {font.encode_text(prefix)} ET Q\n"
+            f"q 1 0 0 1 {x + prefix_width:.5f} {y:.2f} cm "
+            f"/{PAGE_COUNT_XOBJECT}{self._section_index(pdf.page) + 1} Do Q"
+        )
+        self.page_count_font = (font, size, color)
+
+    def close(self):
+        """Finish the last page and write everything that waited for the end."""
+        pdf = self.pdf
+        if pdf.page == 0:
+            pdf.add_page()
+        pdf._render_footer()
+        self.flush_pages(pdf.pages_count)
+
+        # Picks the counts' glyphs before the font subsets are cut
+        ends = self._section_starts[1:] + [pdf.pages_count + 1]
+        xobjects = {}
+        for index, ((first, count_id, _), end) in enumerate(zip(self.sections, ends), 1):
+            page_count = b""
+            if self.page_count_font is not None:
+                font, size, color = self.page_count_font
+                page_count = (
+                    f"BT /F{font.i} {size:.2f} Tf 0 0 Td {color} "
+                    f"{font.encode_text(str(end - first))} ET"
+                ).encode("latin-1")
+            self._form(count_id, page_count, placed=True)
+            xobjects[f"{PAGE_COUNT_XOBJECT}{index}"] = count_id
+        xobjects.update(self.forms.values())
+
+        producer = OutputProducer(pdf)
+        producer.obj_id = self.obj_id
+        FONTS.apply_subsets(pdf)
+        font_objs = producer._add_fonts({}, {}, {})
+        info_obj = producer._add_info()
+        for obj in producer.pdf_objs:
+            self._emit(obj)
+        self.obj_id = producer.obj_id
+
+        fonts = create_dictionary_string(
+            {f"/F{index}": pdf_ref(obj.id) for index, obj in sorted(font_objs.items())}
+        )
+        self._object(self.resources_id, {
+            "/Font": fonts,
+            "/ProcSet": "[/PDF /Text /ImageB /ImageC /ImageI]",
+            "/XObject": create_dictionary_string(
+                {f"/{name}": pdf_ref(obj_id) for name, obj_id in xobjects.items()}
+            ),
+        })
+        width, height = pdf.default_page_dimensions
+        self._object(self.pages_root_id, {
+            "/Type": "/Pages",
+            "/Count": len(self.page_ids),
+            "/Kids": "[" + " ".join(pdf_ref(page_id) for page_id in self.page_ids) + "]",
+            "/MediaBox": f"[0 0 {width:.2f} {height:.2f}]",
+        })
+        catalog = {
+            "/Type": "/Catalog",
+            "/Pages": pdf_ref(self.pages_root_id),
+            "/OpenAction": f"[{pdf_ref(self.page_ids[0])} /FitH null]",
+            "/PageLayout": "/OneColumn",
+        }
+        titled = [(first, title) for first, _, title in self.sections if title is not None]
+        if titled:
+            catalog["/Outlines"] = pdf_ref(self._write_outline(titled))
+            catalog["/PageMode"] = "/UseOutlines"
+            labels = " ".join(
+                f"{first - 1} <</S /D /P {PDFString(title + ' - ').serialize()}>>"
+                for first, title in titled
+            )
+            catalog["/PageLabels"] = f"<</Nums [{labels}]>>"
+        catalog_id = self._reserve()
+        self._object(catalog_id, catalog)
+        self._write_object_stream()
+
+        if pdf.creation_date:
+            self._hash.update(pdf.creation_date.strftime("%Y%m%d%H%M%S").encode("utf8"))
+        file_id = self._hash.hexdigest().upper()
+        if self.object_streams:
+            self._write_xref_stream(catalog_id, info_obj.id, file_id)
+            pdf.stream = None
+            return self.position
+        startxref = self.position
+        count = self.obj_id + 1
+        lines = ["xref", f"0 {count}", "0000000000 65535 f "]
+        lines.extend(f"{self.offsets[obj_id]:010} 00000 n " for obj_id in range(1, count))
+        lines += [
+            "trailer", "<<", f"/Size {count}", f"/Root {pdf_ref(catalog_id)}",
+            f"/Info {pdf_ref(info_obj.id)}", f"/ID [<{file_id}><{file_id}>]", ">>",
+            "startxref", str(startxref), "%%EOF",
+        ]
+        self._out("\n".join(lines))
+        pdf.stream = None
+        return self.position
+
+    def _write_xref_stream(self, catalog_id, info_id, file_id):
+        # Rows of (type, field 2, field 3) packed as 1 + 4 + 2 bytes: type 1
+        # is an offset in the file, type 2 an object stream and the index
+        # of the object in it
+        xref_id = self._reserve()
+        startxref = self.position
+        self.offsets[xref_id] = startxref
+        rows = [struct.pack(">BIH", 0, 0, 65535)]
+        for obj_id in range(1, xref_id + 1):
+            if obj_id in self.packed_at:
+                rows.append(struct.pack(">BIH", 2, *self.packed_at[obj_id]))
+            else:
+                rows.append(struct.pack(">BIH", 1, self.offsets[obj_id], 0))
+        self._stream_object(xref_id, {
+            "/Type": "/XRef",
+            "/Size": xref_id + 1,
+            "/W": "[1 4 2]",
+            "/Root": pdf_ref(catalog_id),
+            "/Info": pdf_ref(info_id),
+            "/ID": f"[<{file_id}><{file_id}>]",
+        }, b"".join(rows))
+        self._out(f"startxref\n{startxref}\n%%EOF")
+
+    def _write_outline(self, titled):
+        # A flat outline: one bookmark per titled section, in page order
+        root_id = self._reserve()
+        item_ids = [self._reserve() for _ in titled]
+        for index, ((first, title), item_id) in enumerate(zip(titled, item_ids)):
+            item = {
+                "/Title": PDFString(title).serialize(),
+                "/Parent": pdf_ref(root_id),
+                "/Dest": f"[{pdf_ref(self.page_ids[first - 1])} /XYZ null null null]",
+            }
+            if index > 0:
+                item["/Prev"] = pdf_ref(item_ids[index - 1])
+            if index + 1 < len(item_ids):
+                item["/Next"] = pdf_ref(item_ids[index + 1])
+            self._object(item_id, item)
+        self._object(root_id, {
+            "/Type": "/Outlines",
+            "/First": pdf_ref(item_ids[0]),
+            "/Last": pdf_ref(item_ids[-1]),
+            "/Count": len(item_ids),
+        })
+        return root_id
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def iter_chunks(produce, max_pending=16):
+    """Run produce(write) on a thread and yield what it writes as it comes.
+
+    At most max_pending chunks wait in between, so a slow consumer holds
+    the producer back instead of letting output pile up in memory. Closing
+    the generator early (a client that went away) stops the producer at
+    its next write.
+    """
+    chunks = queue.Queue(maxsize=max_pending)
+    cancelled = threading.Event()
+    done = object()
+    failure = []
+
+    def put(chunk):
+        while not cancelled.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _Cancelled
+
+    def run():
+        try:
+            produce(put)
+        except _Cancelled:
+            pass
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            try:
+                put(done)
+            except _Cancelled:
+                pass
+
+    thread = threading.Thread(target=run, name="pdf-stream", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        cancelled.set()
+        thread.join()
+    if failure:
+        raise failure[0]
@@ -0,0 +1,58 @@
+"""A small sampling profiler for one block of code on one thread.
+
+    with SamplingProfiler() as profile:
+        create_pdf(invoice)
+    open("render.folded", "w").write(profile.folded())
+
+folded() returns collapsed stacks ("outer;inner;leaf count" per line), the
+input format of flamegraph.pl and speedscope. Sampling reads the target
+thread's frame from a background thread, so the code under test runs
+unmodified. Samples can only be taken when the GIL changes hands, so the
+interpreter's switch interval is lowered to the sampling interval while
+profiling.
+"""
+import collections
+import os
+import sys
+import threading
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.001, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._switch_interval = None
+
+    def __enter__(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        # Lets the sampler get the GIL back at roughly the sampling rate
+        self._switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch_interval, self.interval))
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        sys.setswitchinterval(self._switch_interval)
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
@@ -0,0 +1,321 @@
+import argparse
+import datetime
+import io
+import math
+import sys
+import warnings
+from itertools import zip_longest
+
+from font_registry import FONTS
+from layout import InvoicePDF
+from metrics import METRICS
+from model import Client, Company, InvalidInvoice, Invoice, InvoiceHeader, Items
+from money import compute_totals, format_rate
+from pdf_stream import StreamingWriter, iter_chunks
+from tax import TAX
+
+ADDITIONAL_INFO = "Payment for this invoice can be made by bank transfer."
+# Creation date of documents without a dated invoice. Never the clock: the
+# same invoice has to give the same bytes, for the caches and the archive.
+UNDATED = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def invoice_from_form(form, items=None):
+    company = Company(
+        name=form.get("company_name", ""),
+        address=form.get("company_address", ""),
+        phone=form.get("company_phone", ""),
+        email=form.get("company_email", ""),
+        nif=form.get("company_nif", "")
+    )
+
+    client = Client(
+        name=form.get("client_name", ""),
+        address=form.get("client_address", ""),
+        nif=form.get("client_nif", "")
+    )
+
+    header = InvoiceHeader(
+        invoice_number=form.get("invoice_number", ""),
+        invoice_date=form.get("invoice_date", ""),
+        payment_method=form.get("payment_method", ""),
+        additional_info=ADDITIONAL_INFO,
+        tax_region=form.get("tax_region", ""),
+        currency=form.get("currency", ""),
+    )
+
+    if items is None:
+        items = items_from_form(form, form_rates(header))
+    return Invoice(company, client, header, items)
+
+
+def form_rates(header):
+    # Named rates of the invoice's region; an unknown region is reported
+    # when the invoice is drawn
+    region = TAX.regions.get(header.tax_region or TAX.default_region)
+    return region.rates if region else {}
+
+
+def items_from_form(form, rates=None):
+    # One item_description/item_qty/item_price/item_vat_rate set per line
+    # item; plain dicts (CSV rows) carry a single item
+    if not hasattr(form, "getlist"):
+        return Items.from_dicts([item_from_form(form, rates)])
+    rows = zip_longest(
+        form.getlist("item_description"),
+        form.getlist("item_qty"),
+        form.getlist("item_price"),
+        form.getlist("item_vat_rate"),
+        fillvalue="",
+    )
+    items = [
+        item_from_form(
+            {"item_description": description, "item_qty": qty, "item_price": price, "item_vat_rate": vat_rate},
+            rates,
+        )
+        for description, qty, price, vat_rate in rows
+        if description or qty or price
+    ]
+    return Items.from_dicts(items or [item_from_form(form, rates)])
+
+
+def _form_number(form, name):
+    # Blank is 0; anything else has to be a finite number, since it is billed
+    value = (form.get(name) or "").strip()
+    if not value:
+        return 0.0
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    if not math.isfinite(number):
+        raise InvalidInvoice(f"{name} {value!r} is not a number")
+    return number
+
+
+def item_from_form(form, rates=None):
+    item = {
+        "description": form.get("item_description", ""),
+        "qty": _form_number(form, "item_qty"),
+        "price": _form_number(form, "item_price"),
+    }
+    # Optional per-line VAT rate as a fraction (0.10) or one of rates by
+    # name ("reduced"); blank keeps the default
+    vat_rate = (form.get("item_vat_rate") or "").strip()
+    if vat_rate:
+        try:
+            rate = float(vat_rate)
+        except ValueError:
+            rate = (rates or {}).get(vat_rate)
+        if rate is None or not 0 <= rate <= 1:
+            raise InvalidInvoice(f"item_vat_rate {vat_rate!r} is neither a fraction between 0 and 1 nor a rate of the tax region")
+        item["vat_rate"] = rate
+    return item
+
+
+def create_pdf(invoice):
+    with METRICS.stage("fonts"):
+        pdf = _new_pdf()
+    with METRICS.stage("layout"):
+        draw_invoice(pdf, invoice)
+    pdf_buffer = io.BytesIO()
+    with METRICS.stage("output"):
+        pdf.output(pdf_buffer)
+    _count_render("buffered", pdf.pages_count, pdf_buffer.tell())
+    pdf_buffer.seek(0)
+    return pdf_buffer
+
+
+def write_pdf(invoice, fileobj, compress_level=None, object_streams=False):
+    """Render straight into fileobj, writing each page as soon as it is
+    finished instead of holding the document; returns the bytes written.
+
+    compress_level and object_streams trade CPU for size, as described in
+    pdf_stream (python benchmark.py --only output shows by how much).
+    """
+    return _stream_pdf(invoice, fileobj.write, compress_level, object_streams)
+
+
+def iter_pdf(invoice, compress_level=None, object_streams=False):
+    """Same as write_pdf, as a generator of byte chunks (e.g. a response body)."""
+    return iter_chunks(lambda write: _stream_pdf(invoice, write, compress_level, object_streams))
+
+
+def _stream_pdf(invoice, write, compress_level=None, object_streams=False):
+    with METRICS.stage("fonts"):
+        pdf = _new_pdf()
+        writer = StreamingWriter(pdf, write, compress_level, object_streams)
+    # Pages are written out as layout goes, so the two stages overlap here
+    with METRICS.stage("layout"):
+        draw_invoice(pdf, invoice)
+    with METRICS.stage("output"):
+        size = writer.close()
+    _count_render("streamed", pdf.pages_count, size)
+    return size
+
+
+def write_combined_pdf(invoices, fileobj, compress_level=None, object_streams=False):
+    """Render many invoices into a single PDF written to fileobj, e.g. for
+    a print run; returns the bytes written.
+
+    Fonts and the header band are written once for the whole document,
+    and pages go out as they are finished, so size and memory follow the
+    page count. Each invoice is its own section: pages numbered "Page 1/n"
+    within it, a page label and a bookmark under its invoice number. The
+    document is dated by its newest invoice.
+    """
+    with METRICS.stage("fonts"):
+        pdf = _new_pdf()
+        writer = StreamingWriter(pdf, fileobj.write, compress_level, object_streams)
+    with METRICS.stage("layout"):
+        for index, invoice in enumerate(invoices, 1):
+            writer.start_section(invoice.header.invoice_number or f"Invoice {index}")
+            draw_invoice(pdf, invoice)
+    with METRICS.stage("output"):
+        size = writer.close()
+    _count_render("combined", pdf.pages_count, size)
+    return size
+
+
+def _count_render(mode, pages, size):
+    METRICS.inc("invoice_renders_total", mode=mode)
+    METRICS.inc("invoice_pages_total", pages)
+    METRICS.inc("invoice_bytes_total", size)
+
+
+def _new_pdf():
+    pdf = InvoicePDF()
+    # Unicode fonts for the euro symbol, parsed once per process
+    FONTS.install(pdf)
+    pdf.set_creation_date(UNDATED)
+    return pdf
+
+
+def draw_invoice(pdf, invoice):
+    company = invoice.company
+    header = invoice.header
+    items = invoice.items
+    region, currency = TAX.for_invoice(invoice)
+    format_money = currency.format
+
+    date = header.date()
+    if date is not None:
+        date = datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc)
+        if pdf.creation_date == UNDATED or date > pdf.creation_date:
+            pdf.creation_date = date
+
+    pdf.alias_nb_pages()
+    pdf.add_page()
+    pdf.set_auto_page_break(auto=True, margin=15)
+
+    # -- Company Info --
+    pdf.set_font("DejaVu", "B", 12)
+    pdf.cell(80, 5, company.name, ln=True)
+    pdf.set_font("DejaVu", "", 12)
+    pdf.multi_cell(80, 5, company.address)
+    # Remove phone here (avoid duplication)
+    pdf.cell(80, 5, f"Email: {company.email}", ln=True)
+    pdf.cell(80, 5, f"Tax ID: {company.nif}", ln=True)
+    pdf.ln(5)
+
+    # -- Invoice Info --
+    pdf.set_font("DejaVu", "B", 12)
+    pdf.cell(40, 5, "Invoice #: ", align="L")
+    pdf.set_font("DejaVu", "", 12)
+    pdf.cell(60, 5, header.invoice_number, ln=False)
+
+    pdf.set_font("DejaVu", "B", 12)
+    pdf.cell(40, 5, "Date: ", align="L")
+    pdf.set_font("DejaVu", "", 12)
+    pdf.cell(40, 5, header.invoice_date, ln=True)
+
+    # Phone
+    pdf.set_font("DejaVu", "B", 12)
+    pdf.cell(40, 5, "Phone: ", align="L")
+    pdf.set_font("DejaVu", "", 12)
+    pdf.cell(60, 5, company.phone, ln=False)
+
+    # Payment Method (with 2 spaces)
+    pdf.set_font("DejaVu", "B", 12)
+    pdf.cell(40, 5, "Payment Method:  ", align="L")  # 2 spaces
+    pdf.set_font("DejaVu", "", 12)
+    pdf.cell(40, 5, header.payment_method, ln=True)
+
+    # Add 3 enters
+    pdf.ln(3)
+    pdf.ln(3)
+    pdf.ln(3)
+
+    # Draw separation line
+    pdf.set_draw_color(0, 0, 0)
+    pdf.set_line_width(0.5)
+    current_y = pdf.get_y()
+    pdf.line(10, current_y, 200, current_y)
+
+    # Add 3 enters again
+    pdf.ln(6)
+    pdf.ln(6)
+    pdf.ln(6)
+
+    # -- Table Header --
+    pdf.table_header()
+
+    # -- Items --
+    with METRICS.stage("totals"):
+        totals = compute_totals(items, region.default_rate)
+    pdf.item_rows(
+        (description, f"{qty}", format_money(price), format_money(line_total))
+        for description, qty, price, line_total
+        in zip(items.descriptions, items.qty, items.price, totals["lines"])
+    )
+
+    # -- Totals --
+    pdf.ln(5)
+    pdf.cell(150, 8, "Subtotal:", align='R')
+    pdf.cell(40, 8, format_money(totals["subtotal"]), align='R', ln=True)
+    for rate, vat_amount in totals["vat"].items():
+        pdf.cell(150, 8, f"VAT ({format_rate(rate)}):", align='R')
+        pdf.cell(40, 8, format_money(vat_amount), align='R', ln=True)
+    pdf.ln(5)
+    pdf.set_font("DejaVu", "B", 12)
+    pdf.cell(150, 8, "Total Due:", align='R')
+    pdf.cell(40, 8, format_money(totals["total"]), align='R', ln=True)
+    pdf.ln(10)
+
+    pdf.set_font("DejaVu", "", 10)
+    pdf.multi_cell(0, 5, header.additional_info)
+
+
+def main(argv=None):
+    """Render one invoice for one-shot runs, without Flask or a worker pool."""
+    parser = argparse.ArgumentParser(description="Render one invoice to PDF.")
+    parser.add_argument("input", help="JSON invoice record, as one line of a batch file; '-' for stdin")
+    parser.add_argument("-o", "--output", default="-", help="PDF file to write (default: stdout)")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9",
+                        help="zlib level for every stream (default: zlib's own, 6)")
+    parser.add_argument("--object-streams", action="store_true",
+                        help="pack objects and the cross-reference table into compressed streams (PDF 1.5)")
+    args = parser.parse_args(argv)
+
+    from schema import invoice_from_json
+    if args.input == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(args.input, "rb") as f:
+            data = f.read()
+    try:
+        invoice = invoice_from_json(data)
+    except InvalidInvoice as e:
+        sys.exit(f"{args.input}: {e}")
+    options = {"compress_level": args.compress_level, "object_streams": args.object_streams}
+    if args.output == "-":
+        write_pdf(invoice, sys.stdout.buffer, **options)
+    else:
+        with open(args.output, "wb") as f:
+            write_pdf(invoice, f, **options)
+
+
+if __name__ == "__main__":
+    # Scripts show DeprecationWarnings from __main__, i.e. fpdf's ln=
+    warnings.simplefilter("ignore", DeprecationWarning)
+    main()
@@ -0,0 +1,169 @@
+"""Parsing and validation of JSON invoice documents (POST /api/invoices).
+
+A document has the shape of a batch JSON Lines record:
+
+    {"company": {...}, "client": {...}, "invoice": {...},
+     "items": [{"description": ..., "qty": ..., "price": ..., "vat_rate": ...}, ...]}
+
+"invoice" may name a tax_region and a currency from tax.TAX, and a line's
+vat_rate may be a rate of that region by name ("reduced").
+
+The field tables below are compiled once into checker functions. A single
+walk over the document both validates it and builds the model, items going
+straight into their columns. Every problem is reported with its path
+instead of stopping at the first one.
+"""
+import json
+import math
+
+from model import MAX_AMOUNT, Client, Company, Invoice, InvoiceHeader, InvalidInvoice, Items
+from render import ADDITIONAL_INFO
+from tax import TAX
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Stop collecting after this many errors; a bad bulk upload would otherwise
+# answer with one message per line item
+MAX_ERRORS = 50
+
+
+class InvalidDocument(InvalidInvoice):
+    def __init__(self, errors):
+        super().__init__("; ".join(f"{path}: {message}" for path, message in errors))
+        self.errors = errors
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _string(value, path, errors):
+    if isinstance(value, str):
+        return value
+    errors.append((path, "must be a string"))
+
+
+def _number(value, path, errors):
+    # bool is an int, but true is not a quantity
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return float(value)
+    errors.append((path, "must be a finite number"))
+
+
+def _rate(value, path, errors):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        # A named rate, looked up once the region is known
+        return value
+    rate = _number(value, path, errors)
+    if rate is not None and not 0 <= rate <= 1:
+        errors.append((path, "must be a fraction between 0 and 1"))
+        return None
+    return rate
+
+
+def _compile_object(fields, required=()):
+    """fields: {name: (checker, default)}. Returns check(value, path, errors)
+    giving a dict of every field, defaults filled in."""
+    defaults = {name: default for name, (_, default) in fields.items()}
+    checkers = {name: checker for name, (checker, _) in fields.items()}
+    required = tuple(required)
+
+    def check(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append((path, "must be an object"))
+            return None
+        result = dict(defaults)
+        for name, field_value in value.items():
+            checker = checkers.get(name)
+            if checker is None:
+                errors.append((f"{path}.{name}", "unknown field"))
+                continue
+            result[name] = checker(field_value, f"{path}.{name}", errors)
+        for name in required:
+            if name not in value:
+                errors.append((f"{path}.{name}", "is required"))
+        return result
+
+    return check
+
+
+def _strings(*names, **defaults):
+    return {name: (_string, defaults.get(name, "")) for name in names}
+
+
+_company = _compile_object(_strings("name", "address", "phone", "email", "nif"))
+_client = _compile_object(_strings("name", "address", "nif"))
+_header = _compile_object(_strings(
+    "invoice_number", "invoice_date", "payment_method", "additional_info", "tax_region", "currency",
+    additional_info=ADDITIONAL_INFO,
+))
+_item = _compile_object(
+    {
+        "description": (_string, ""),
+        "qty": (_number, None),
+        "price": (_number, None),
+        "vat_rate": (_rate, None),
+    },
+    required=("qty", "price"),
+)
+_SECTIONS = {"company", "client", "invoice", "items"}
+
+
+def invoice_from_document(document):
+    """Validate a decoded document and build the Invoice, or raise
+    InvalidDocument listing every (path, message) found."""
+    errors = []
+    if not isinstance(document, dict):
+        raise InvalidDocument([("$", "must be an object")])
+    for name in document.keys() - _SECTIONS:
+        errors.append((f"$.{name}", "unknown field"))
+
+    company = _company(document.get("company", {}), "$.company", errors)
+    client = _client(document.get("client", {}), "$.client", errors)
+    header = _header(document.get("invoice", {}), "$.invoice", errors)
+    region = None
+    if header is not None:
+        region = TAX.regions.get(header["tax_region"] or TAX.default_region)
+        if region is None:
+            errors.append(("$.invoice.tax_region", "unknown tax region"))
+        if header["currency"] and header["currency"] not in TAX.currencies:
+            errors.append(("$.invoice.currency", "unknown currency"))
+    items = Items()
+    lines = document.get("items", [])
+    if not isinstance(lines, list):
+        errors.append(("$.items", "must be an array"))
+        lines = ()
+    for index, line in enumerate(lines):
+        if len(errors) >= MAX_ERRORS:
+            break
+        checked = len(errors)
+        item = _item(line, f"$.items[{index}]", errors)
+        if item is not None and isinstance(item["vat_rate"], str):
+            item["vat_rate"] = region.rates.get(item["vat_rate"]) if region else None
+            if item["vat_rate"] is None and region:
+                errors.append((f"$.items[{index}].vat_rate", f"not a rate of tax region {region.key}"))
+        if len(errors) == checked and abs(item["qty"] * item["price"]) > MAX_AMOUNT:
+            errors.append((f"$.items[{index}]", f"qty * price must be at most {MAX_AMOUNT:,}"))
+        if len(errors) == checked:
+            items.append(**item)
+
+    if errors:
+        raise InvalidDocument(errors[:MAX_ERRORS])
+    return Invoice(Company(**company), Client(**client), InvoiceHeader(**header), items)
+
+
+def invoice_from_json(data):
+    """Parse JSON text or bytes into an Invoice; malformed JSON is an
+    InvalidDocument too."""
+    try:
+        document = loads(data)
+    except ValueError as e:
+        raise InvalidDocument([("$", f"invalid JSON: {e}")]) from None
+    return invoice_from_document(document)
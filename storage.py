@@ -0,0 +1,85 @@
+"""On-disk state shared by threads and forked worker processes.
+
+SQLite databases are opened once per thread and per process, since a
+connection survives neither a fork nor being used from another thread.
+Files are written next to their destination and renamed over it, so
+readers in other processes see the old file or the new one, never a
+partial one.
+"""
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+
+class ThreadConnections:
+    """Calling it returns this thread's connection to path, opened with
+    options (sqlite3.connect's) and then the setup statements."""
+
+    def __init__(self, path, setup=(), row_factory=None, **options):
+        self.path = path
+        self.setup = setup
+        self.row_factory = row_factory
+        self.options = {"timeout": 30, **options}
+        self._local = threading.local()
+
+    def __call__(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, **self.options)
+            for statement in self.setup:
+                db.execute(statement)
+            if self.row_factory is not None:
+                db.row_factory = self.row_factory
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def ready(self):
+        """Whether the database opens and its schema can be read."""
+        try:
+            self().execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+
+def process_alive(pid):
+    """Whether a process of this host has the given pid."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Someone else's
+        pass
+    return True
+
+
+@contextmanager
+def atomic_write(path, mode="wb", encoding=None, directory=None):
+    """Open a temporary file and rename it to path once the with-block is
+    done; if the block raises it is removed instead.
+
+    path may be a function, called after the block, for files named after
+    what was written into them; the temporary file then goes in directory,
+    which must be on the same filesystem.
+    """
+    directory = directory or os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as f:
+            yield f
+        if callable(path):
+            path = path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # mkstemp makes it private; files built at image build time are
+        # read by whichever user the service runs as
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
@@ -0,0 +1,163 @@
+"""VAT rates and currency formats by tax region.
+
+The tables are read once per process, from the JSON file named by
+TAX_CONFIG or else from DEFAULT_CONFIG, which has the same shape:
+
+    {"default_region": "ES",
+     "currencies": {"EUR": {"pattern": "{number} €", "decimal": ".", "group": ""}, ...},
+     "regions": {"ES": {"currency": "EUR", "default_rate": "general",
+                        "rates": {"general": "0.21", "reduced": "0.10", ...}}, ...}}
+
+They are then turned into Region and CurrencyFormat objects. An invoice
+picks its region and, optionally, a currency other than the region's by
+key, and a line can name its rate ("reduced") instead of giving the
+fraction. Nothing is parsed or built per invoice, so a batch that mixes
+regions costs the same as one that doesn't. Amounts are kept to the cent
+in every currency.
+"""
+import hashlib
+import json
+import os
+from decimal import InvalidOperation
+
+from model import InvalidInvoice
+from money import cents, compute_totals, to_decimal
+
+DEFAULT_CONFIG = {
+    "default_region": "ES",
+    "currencies": {
+        "EUR": {"pattern": "{number} €", "decimal": ".", "group": ""},
+        "GBP": {"pattern": "£{number}", "decimal": ".", "group": ","},
+        "USD": {"pattern": "${number}", "decimal": ".", "group": ","},
+        "CHF": {"pattern": "CHF {number}", "decimal": ".", "group": "'"},
+    },
+    "regions": {
+        "ES": {
+            "currency": "EUR",
+            "default_rate": "general",
+            "rates": {"general": "0.21", "reduced": "0.10", "super_reduced": "0.04", "exempt": "0"},
+        },
+        "PT": {
+            "currency": "EUR",
+            "default_rate": "normal",
+            "rates": {"normal": "0.23", "intermediate": "0.13", "reduced": "0.06", "exempt": "0"},
+        },
+        "FR": {
+            "currency": "EUR",
+            "default_rate": "normal",
+            "rates": {"normal": "0.20", "intermediate": "0.10", "reduced": "0.055", "super_reduced": "0.021", "exempt": "0"},
+        },
+        "GB": {
+            "currency": "GBP",
+            "default_rate": "standard",
+            "rates": {"standard": "0.20", "reduced": "0.05", "zero": "0"},
+        },
+        "CH": {
+            "currency": "CHF",
+            "default_rate": "standard",
+            "rates": {"standard": "0.081", "accommodation": "0.038", "reduced": "0.026", "exempt": "0"},
+        },
+    },
+}
+
+
+class CurrencyFormat:
+    """Writes amounts of one currency: pattern places the number (e.g.
+    "£{number}"), decimal and group are the separators. The format spec and
+    the separator table are worked out once, here."""
+
+    __slots__ = ("code", "pattern", "_spec", "_separators")
+
+    def __init__(self, code, pattern, decimal=".", group=""):
+        if "{number}" not in pattern:
+            raise ValueError(f"currency {code}: pattern must contain {{number}}")
+        self.code = code
+        self.pattern = pattern
+        self._spec = ",f" if group else "f"
+        self._separators = str.maketrans({",": group, ".": decimal})
+
+    def format(self, amount):
+        amount = cents(to_decimal(amount))
+        number = format(abs(amount), self._spec).translate(self._separators)
+        sign = "-" if amount < 0 else ""
+        return sign + self.pattern.replace("{number}", number)
+
+
+class Region:
+    __slots__ = ("key", "currency", "default_rate", "rates")
+
+    def __init__(self, key, currency, default_rate, rates):
+        self.key = key
+        self.currency = currency
+        self.default_rate = default_rate
+        self.rates = rates
+
+
+class TaxTables:
+    def __init__(self, config):
+        # Part of render cache keys: PDFs drawn with other rates or formats
+        # stop matching when the configuration changes
+        self.fingerprint = hashlib.sha256(
+            json.dumps(config, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        ).hexdigest()
+        try:
+            self.currencies = {
+                code: CurrencyFormat(code, **spec) for code, spec in config["currencies"].items()
+            }
+            self.regions = {key: self._region(key, spec) for key, spec in config["regions"].items()}
+            self.default_region = config["default_region"]
+        except (AttributeError, InvalidOperation, KeyError, TypeError) as e:
+            raise ValueError(f"invalid tax configuration: {e!r}") from None
+        if self.default_region not in self.regions:
+            raise ValueError(f"default region {self.default_region!r} has no rates")
+
+    def _region(self, key, spec):
+        if spec["currency"] not in self.currencies:
+            raise ValueError(f"region {key}: unknown currency {spec['currency']!r}")
+        rates = {name: to_decimal(str(rate)) for name, rate in spec["rates"].items()}
+        if not all(0 <= rate <= 1 for rate in rates.values()):
+            raise ValueError(f"region {key}: rates must be fractions between 0 and 1")
+        if spec["default_rate"] not in rates:
+            raise ValueError(f"region {key}: default rate {spec['default_rate']!r} is not in its rates")
+        return Region(
+            key,
+            self.currencies[spec["currency"]],
+            rates[spec["default_rate"]],
+            # Items holds rates as floats
+            {name: float(rate) for name, rate in rates.items()},
+        )
+
+    @classmethod
+    def load(cls, path=None):
+        path = path or os.environ.get("TAX_CONFIG")
+        if not path:
+            return cls(DEFAULT_CONFIG)
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def region(self, key=""):
+        """The region for key, the default one for ""."""
+        region = self.regions.get(key or self.default_region)
+        if region is None:
+            raise InvalidInvoice(f"unknown tax region {key!r}")
+        return region
+
+    def currency(self, key):
+        currency = self.currencies.get(key)
+        if currency is None:
+            raise InvalidInvoice(f"unknown currency {key!r}")
+        return currency
+
+    def for_invoice(self, invoice):
+        """(region, currency format) an invoice is written in."""
+        header = invoice.header
+        region = self.region(header.tax_region)
+        currency = self.currency(header.currency) if header.currency else region.currency
+        return region, currency
+
+    def totals(self, invoice):
+        """compute_totals with the invoice's region's default rate."""
+        return compute_totals(invoice.items, self.region(invoice.header.tax_region).default_rate)
+
+
+TAX = TaxTables.load()
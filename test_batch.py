@@ -0,0 +1,38 @@
+import io
+
+from batch import BadRecord, read_csv, read_jsonl
+
+
+def read(text):
+    return list(read_csv(io.StringIO(
+        "invoice_number,client_name,item_description,item_qty,item_price,item_vat_rate\n" + text
+    )))
+
+
+def test_csv_rows_that_cannot_be_billed_are_reported():
+    invoices = read(
+        "A-1,Bob,Design,x,100,\n"
+        "A-1,Bob,Hosting,1,20,\n"
+        "A-2,Carol,Design,1,,\n"
+        "A-3,Dan,Support,1,30,reduced-ish\n"
+        "A-4,Erin,Support,1,30,reduced\n"
+    )
+
+    assert [type(invoice).__name__ for invoice in invoices] == ["BadRecord", "Invoice", "BadRecord", "Invoice"]
+    assert str(invoices[0]).startswith("line 2: item_qty 'x'")
+    # A blank price is a zero one, as in the form
+    assert invoices[1].client.name == "Carol" and list(invoices[1].items)[0]["price"] == 0
+    assert isinstance(invoices[2], BadRecord) and "line 5" in str(invoices[2])
+    assert list(invoices[3].items)[0]["vat_rate"] == 0.10
+
+
+def test_jsonl_records_are_validated_as_api_documents():
+    invoices = list(read_jsonl(io.StringIO(
+        '{"items": [{"qty": true, "price": 10}]}\n'
+        '{"items": [{"qty": 1, "price": 10, "vat_rate": true}]}\n'
+        '{"invoice": {"tax_region": "GB"}, "items": [{"qty": 1, "price": 10, "vat_rate": "reduced"}]}\n'
+    )))
+
+    assert [type(invoice).__name__ for invoice in invoices] == ["BadRecord", "BadRecord", "Invoice"]
+    assert "$.items[0].qty" in str(invoices[0])
+    assert list(invoices[2].items)[0]["vat_rate"] == 0.05
@@ -0,0 +1,42 @@
+import shutil
+import subprocess
+import sys
+import time
+
+from jobs import JobQueue
+
+
+def test_jobs_of_a_process_that_exited_fail_instead_of_staying_queued(tmp_path):
+    jobs = JobQueue(str(tmp_path))
+    gone = subprocess.Popen([sys.executable, "-c", "pass"])
+    gone.wait()
+    with jobs._db() as db:
+        db.execute("INSERT INTO jobs (id, kind, status, created, owner) VALUES ('lost', 'pdf', 'running', ?, ?)",
+                   (time.time(), gone.pid))
+
+    job = jobs.get("lost")
+    assert job["status"] == "failed"
+    assert "exited" in job["error"]
+
+
+def test_finished_and_stale_jobs_are_pruned(tmp_path):
+    jobs = JobQueue(str(tmp_path), ttl=10)
+    with jobs._db() as db:
+        db.execute("INSERT INTO jobs (id, kind, status, created, finished) VALUES ('done', 'pdf', 'done', 0, 1)")
+        db.execute("INSERT INTO jobs (id, kind, status, created, owner) VALUES ('stuck', 'pdf', 'running', 0, 1)")
+
+    job_id = jobs.submit("pdf", lambda output_path: open(output_path, "wb").close())
+
+    assert jobs.get("done") is None
+    assert jobs.get("stuck") is None
+    assert jobs.get(job_id) is not None
+
+
+def test_queue_is_not_ready_when_its_database_cannot_be_opened(tmp_path):
+    jobs = JobQueue(str(tmp_path / "jobs"))
+    assert jobs.ready()
+
+    shutil.rmtree(tmp_path / "jobs")
+    # Connections are per thread: a new thread would open the file again
+    jobs._db._local.db = None
+    assert not jobs.ready()
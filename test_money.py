@@ -0,0 +1,57 @@
+from decimal import ROUND_HALF_EVEN, ROUND_HALF_UP, Decimal
+from random import Random
+
+import pytest
+
+from model import MAX_AMOUNT, InvalidInvoice, Items
+from money import DEFAULT_VAT_RATE, _array_lines, compute_totals
+from schema import InvalidDocument, invoice_from_document
+
+
+def test_line_amounts_past_the_limit_are_invalid_not_an_overflow():
+    items = Items()
+    items.append("largest", MAX_AMOUNT, 1)
+    assert compute_totals(items)["subtotal"] == MAX_AMOUNT
+
+    with pytest.raises(InvalidInvoice):
+        items.append("too large", 1e13, 1e13)
+    with pytest.raises(InvalidDocument) as e:
+        invoice_from_document({"items": [{"qty": 1e13, "price": 1e13}]})
+    assert e.value.errors[0][0] == "$.items[0]"
+
+
+def test_lines_are_rounded_exactly_and_vat_once_per_rate():
+    items = Items.from_dicts([
+        {"description": "a", "qty": 3, "price": 0.335},
+        {"description": "b", "qty": 1, "price": 0.02, "vat_rate": 0.25},
+        {"description": "c", "qty": 1, "price": 0.02, "vat_rate": 0.25},
+    ])
+
+    totals = compute_totals(items, "0.21")
+    # 1.005 as typed, not the float just below it
+    assert totals["lines"] == [Decimal("1.01"), Decimal("0.02"), Decimal("0.02")]
+    # 25% of the 0.04 at that rate, not 0.01 for each 0.005
+    assert totals["vat"] == {Decimal("0.21"): Decimal("0.21"), Decimal("0.25"): Decimal("0.01")}
+    assert totals["subtotal"] == Decimal("1.05")
+    assert totals["total"] == totals["subtotal"] + totals["vat_total"] == Decimal("1.27")
+    assert compute_totals(items, "0.21", rounding=ROUND_HALF_EVEN)["lines"][0] == Decimal("1.00")
+
+
+@pytest.mark.parametrize("rounding", [ROUND_HALF_UP, ROUND_HALF_EVEN])
+def test_numpy_totals_match_decimal_ones(rounding):
+    pytest.importorskip("numpy")
+    random = Random(rounding)
+    items = Items.from_dicts(
+        {
+            "description": "x",
+            "qty": random.randrange(-2000, 100000) / 1000,
+            "price": random.randrange(0, 10 ** 7) / 100,
+            "vat_rate": random.choice([None, 0.0, 0.04, 0.1, 0.21]),
+        }
+        for _ in range(5000)
+    )
+    # Guard against the array path quietly falling back to Decimal
+    assert _array_lines(items, DEFAULT_VAT_RATE, rounding)[0] is not None
+    assert compute_totals(items, rounding=rounding, use_numpy=True) == compute_totals(
+        items, rounding=rounding, use_numpy=False
+    )
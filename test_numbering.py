@@ -0,0 +1,88 @@
+import datetime
+import io
+import sqlite3
+
+from batch import BadRecord, number_invoices, read_csv
+from numbering import Ledger
+
+CSV_HEADER = "client_name,client_nif,invoice_number,invoice_date,item_description,item_qty,item_price\n"
+
+
+def read(text):
+    return list(read_csv(io.StringIO(CSV_HEADER + text)))
+
+
+def issued(path):
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT invoice_number, client_nif FROM issued ORDER BY number").fetchall()
+
+
+def test_csv_rows_without_a_number_are_separate_invoices(tmp_path):
+    path = str(tmp_path / "ledger.sqlite3")
+    ledger = Ledger(path, block_size=8, flush_every=8)
+    invoices = list(number_invoices(read(
+        "Bob,B1,,01/05/2026,Design,1,100\n"
+        "Carol,C1,,01/05/2026,Hosting,2,20\n"
+        "Dan,D1,,01/05/2026,Support,3,30\n"
+    ), ledger))
+    ledger.close()
+
+    assert [invoice.client.name for invoice in invoices] == ["Bob", "Carol", "Dan"]
+    assert [len(invoice.items) for invoice in invoices] == [1, 1, 1]
+    assert [invoice.header.invoice_number for invoice in invoices] == ["2026/00001", "2026/00002", "2026/00003"]
+    assert issued(path) == [("2026/00001", "B1"), ("2026/00002", "C1"), ("2026/00003", "D1")]
+    # The rest of the block went back: the next number follows on
+    assert Ledger(path).next_number(year=2026) == 4
+
+
+def test_csv_rows_group_by_invoice_number_or_ref():
+    invoices = list(read_csv(io.StringIO(
+        "invoice_ref,client_name,invoice_number,item_description,item_qty,item_price\n"
+        ",Bob,A-1,Design,1,100\n"
+        ",Bob,A-1,Hosting,1,20\n"
+        "x,Carol,,Design,1,100\n"
+        "x,Carol,,Hosting,1,20\n"
+        "y,Dan,,Support,1,30\n"
+    )))
+
+    assert [(invoice.client.name, len(invoice.items)) for invoice in invoices] == [("Bob", 2), ("Carol", 2), ("Dan", 1)]
+
+
+def test_unknown_tax_region_is_reported_without_using_a_number(tmp_path):
+    path = str(tmp_path / "ledger.sqlite3")
+    ledger = Ledger(path)
+    invoices = list(number_invoices(read_csv(io.StringIO(
+        "client_name,client_nif,invoice_number,invoice_date,tax_region,item_description,item_qty,item_price\n"
+        "Bob,B1,,01/05/2026,,Design,1,100\n"
+        "Carol,C1,,01/05/2026,ZZ,Hosting,2,20\n"
+        "Dan,D1,,01/05/2026,GB,Support,3,30\n"
+    )), ledger))
+    ledger.close()
+
+    assert isinstance(invoices[1], BadRecord)
+    assert "line 3" in str(invoices[1])
+    assert [invoice.header.invoice_number for invoice in (invoices[0], invoices[2])] == ["2026/00001", "2026/00002"]
+    assert Ledger(path).unissued(year=2026) == []
+
+
+def test_issue_takes_no_number_for_an_invoice_it_cannot_total(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.sqlite3"))
+    invoice = read("Bob,B1,,01/05/2026,Design,1,100\n")[0]
+    invoice.header.tax_region = "ZZ"
+
+    assert isinstance(next(number_invoices([invoice], ledger)), BadRecord)
+    assert invoice.header.invoice_number == ""
+    assert ledger.next_number(year=2026) == 1
+
+
+def test_invoices_number_in_the_year_of_their_date(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.sqlite3"))
+    invoices = list(number_invoices(read(
+        "Bob,B1,,31/12/2019,Design,1,100\n"
+        "Carol,C1,,2019-12-31,Hosting,2,20\n"
+    ), ledger))
+    ledger.close()
+
+    assert invoices[0].header.invoice_number == "2019/00001"
+    # Not a DD/MM/YYYY date: numbered in the current year
+    assert invoices[1].header.invoice_number == f"{datetime.date.today().year}/00001"
@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+from model import Items
+from render import create_pdf, invoice_from_form, iter_pdf, write_combined_pdf, write_pdf
+
+pymupdf = pytest.importorskip("pymupdf")
+
+
+def invoice(lines, number):
+    return invoice_from_form(
+        {"invoice_number": number, "invoice_date": "01/05/2026", "client_name": "Client"},
+        items=Items.from_dicts([{"description": f"Item {i}", "qty": 1, "price": i + 0.5} for i in range(lines)]),
+    )
+
+
+INVOICES = [invoice(1, "A-1"), invoice(120, "A-2")]
+
+
+def open_pdf(data):
+    pymupdf.TOOLS.mupdf_warnings()
+    document = pymupdf.open(stream=data, filetype="pdf")
+    # Broken xref offsets or object streams make MuPDF rebuild the table
+    assert not document.is_repaired
+    assert pymupdf.TOOLS.mupdf_warnings() == ""
+    return document
+
+
+def pages(document):
+    return [(page.get_text(), page.get_pixmap(dpi=72).samples) for page in document]
+
+
+@pytest.fixture(scope="module")
+def buffered():
+    return [pages(open_pdf(create_pdf(inv).getvalue())) for inv in INVOICES]
+
+
+@pytest.mark.parametrize("object_streams", [False, True])
+@pytest.mark.parametrize("compress_level", [None, 0, 9])
+@pytest.mark.parametrize("index", range(len(INVOICES)))
+def test_streamed_pages_match_buffered_ones(buffered, index, compress_level, object_streams):
+    out = io.BytesIO()
+    size = write_pdf(INVOICES[index], out, compress_level=compress_level, object_streams=object_streams)
+    data = out.getvalue()
+
+    assert size == len(data)
+    assert data.startswith(b"%PDF-1.5" if object_streams else b"%PDF-1.")
+    assert pages(open_pdf(data)) == buffered[index]
+
+
+def test_iter_pdf_gives_write_pdf_bytes():
+    out = io.BytesIO()
+    write_pdf(INVOICES[0], out)
+    assert b"".join(iter_pdf(INVOICES[0])) == out.getvalue()
+
+
+@pytest.mark.parametrize("object_streams", [False, True])
+def test_combined_pdf_is_the_buffered_pages_in_sections(buffered, object_streams):
+    out = io.BytesIO()
+    write_combined_pdf(INVOICES, out, object_streams=object_streams)
+    document = open_pdf(out.getvalue())
+
+    assert pages(document) == [page for invoice_pages in buffered for page in invoice_pages]
+    assert document.get_toc() == [[1, "A-1", 1], [1, "A-2", 2]]
+    assert [page.get_label() for page in document] == ["A-1 - 1"] + [f"A-2 - {n}" for n in range(1, 6)]
+
+
+def test_output_is_deterministic():
+    assert create_pdf(INVOICES[1]).getvalue() == create_pdf(INVOICES[1]).getvalue()
+    assert b"".join(iter_pdf(INVOICES[1], object_streams=True)) == b"".join(iter_pdf(INVOICES[1], object_streams=True))
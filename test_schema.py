@@ -0,0 +1,66 @@
+import pytest
+
+from schema import MAX_ERRORS, InvalidDocument, invoice_from_document, invoice_from_json
+
+
+def errors(document):
+    with pytest.raises(InvalidDocument) as e:
+        invoice_from_document(document)
+    return dict(e.value.errors)
+
+
+def test_valid_document_builds_the_invoice():
+    invoice = invoice_from_document({
+        "company": {"name": "Acme"},
+        "invoice": {"invoice_number": "A-1", "tax_region": "FR", "currency": "USD"},
+        "items": [
+            {"description": "Design", "qty": 2, "price": 10.5},
+            {"qty": 1, "price": 3, "vat_rate": "reduced"},
+            {"qty": 1, "price": 3, "vat_rate": 0},
+        ],
+    })
+
+    assert invoice.company.name == "Acme" and invoice.client.name == ""
+    assert invoice.header.currency == "USD"
+    assert [item.get("vat_rate") for item in invoice.items] == [None, 0.055, 0.0]
+
+
+def test_every_problem_is_reported_with_its_path():
+    assert errors({
+        "extra": 1,
+        "company": {"name": 1, "fax": ""},
+        "invoice": {"tax_region": "XX", "currency": "XYZ"},
+        "items": [
+            {"qty": True, "price": float("inf")},
+            {"price": 1, "vat_rate": 1.5},
+            {"qty": 1, "price": 1, "vat_rate": "reduced"},
+        ],
+    }) == {
+        "$.extra": "unknown field",
+        "$.company.name": "must be a string",
+        "$.company.fax": "unknown field",
+        "$.invoice.tax_region": "unknown tax region",
+        "$.invoice.currency": "unknown currency",
+        "$.items[0].qty": "must be a finite number",
+        "$.items[0].price": "must be a finite number",
+        "$.items[1].vat_rate": "must be a fraction between 0 and 1",
+        "$.items[1].qty": "is required",
+    }
+    assert errors({"items": [{"qty": 1, "price": 1, "vat_rate": "zero"}]}) == {
+        "$.items[0].vat_rate": "not a rate of tax region ES",
+    }
+    assert errors({"items": {}}) == {"$.items": "must be an array"}
+    assert errors([]) == {"$": "must be an object"}
+
+
+def test_errors_stop_at_the_limit():
+    with pytest.raises(InvalidDocument) as e:
+        invoice_from_document({"items": [{"qty": "1", "price": 1}] * (MAX_ERRORS * 2)})
+    assert len(e.value.errors) == MAX_ERRORS
+
+
+def test_malformed_json_is_an_invalid_document():
+    with pytest.raises(InvalidDocument) as e:
+        invoice_from_json(b'{"items": [')
+    assert e.value.errors[0][0] == "$"
+    assert len(invoice_from_json('{"items": [{"qty": 1, "price": 1}]}').items) == 1
@@ -0,0 +1,49 @@
+import copy
+from decimal import Decimal
+
+import pytest
+
+from tax import DEFAULT_CONFIG, TaxTables
+
+
+def config(**changes):
+    result = copy.deepcopy(DEFAULT_CONFIG)
+    for path, value in changes.items():
+        *parents, name = path.split("__")
+        target = result
+        for parent in parents:
+            target = target[parent]
+        if value is None:
+            del target[name]
+        else:
+            target[name] = value
+    return result
+
+
+def test_default_tables():
+    tax = TaxTables(DEFAULT_CONFIG)
+    gb = tax.region("GB")
+    assert gb.default_rate == Decimal("0.20") and gb.rates["reduced"] == 0.05
+    assert tax.region("") is tax.regions["ES"]
+    assert gb.currency.format(Decimal("-1234.565")) == "-£1,234.57"
+    assert tax.currency("CHF").format(1234567.8) == "CHF 1'234'567.80"
+    assert tax.currency("EUR").format(1234.5) == "1234.50 €"
+    assert TaxTables(config()).fingerprint == tax.fingerprint
+    assert TaxTables(config(regions__GB__rates__reduced="0.06")).fingerprint != tax.fingerprint
+
+
+@pytest.mark.parametrize("changes, message", [
+    ({"regions__GB__currency": "XYZ"}, "unknown currency"),
+    ({"regions__GB__rates__reduced": "1.5"}, "between 0 and 1"),
+    ({"regions__GB__rates__reduced": "-0.05"}, "between 0 and 1"),
+    ({"regions__GB__default_rate": "general"}, "default rate"),
+    ({"default_region": "XX"}, "default region"),
+    ({"currencies__GBP__pattern": "£"}, "{number}"),
+    ({"regions__GB__rates": None}, "invalid tax configuration"),
+    ({"currencies__GBP__symbol": "£"}, "invalid tax configuration"),
+    ({"regions__GB__rates__reduced": "five"}, "invalid tax configuration"),
+    ({"regions": []}, "invalid tax configuration"),
+])
+def test_bad_configuration_is_rejected(changes, message):
+    with pytest.raises(ValueError, match=message):
+        TaxTables(config(**changes))